@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measure latency and throughput of the communication with the robot.
+
+The robot is emulated (see epuck.emulator) in a separate process, so the
+measured CPU time belongs to the communication only. For every scenario
+the latency percentiles, commands per second and CPU time per command are
+printed and saved to a JSON file, which can be compared between versions.
+
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from epuck.comm import AsyncComm, SyncComm, EventLoop, LoopComm
+from epuck.controller import Controller
+from epuck.emulator import Emulator
+
+PERCENTILES = [50, 90, 99]
+
+
+def run_emulator(connection, bandwidth, latency):
+    """Run the emulator until anything is received from the connection."""
+    emulator = Emulator(bandwidth=bandwidth, latency=latency)
+    emulator.start()
+    connection.send(emulator.port)
+    connection.recv()
+    emulator.stop()
+
+
+class Robot(object):
+    """Emulated robot running in a separate process."""
+
+    def __init__(self, bandwidth, latency):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=run_emulator,
+                                               args=(child, bandwidth, latency))
+        self.process.daemon = True
+        self.process.start()
+        self.port = self.connection.recv()
+
+    def stop(self):
+        self.connection.send(None)
+        self.process.join()
+
+
+class Measurement(object):
+    """Collect latencies of the commands and the time spent."""
+
+    def __init__(self):
+        self.latencies = []
+        self.frames = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        self.start_cpu = sum(os.times()[:2])
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.time() - self.start
+        self.cpu = sum(os.times()[:2]) - self.start_cpu
+
+    def timed(self, sent_at):
+        """Return callback recording the latency of the command."""
+        def _callback(response):
+            self.latencies.append(time.time() - sent_at)
+            return response
+        return _callback
+
+    def result(self):
+        """Return the results as a dictionary."""
+        count = len(self.latencies)
+        latencies = sorted(self.latencies)
+        result = {
+            'commands': count,
+            'seconds': self.seconds,
+            'commands_per_second': count / self.seconds,
+            'cpu_per_command_us': 1e6 * self.cpu / count,
+            'latency_ms': {
+                'mean': 1e3 * sum(latencies) / count,
+                'max': 1e3 * latencies[-1],
+            },
+        }
+        for p in PERCENTILES:
+            index = min(count - 1, int(round(p / 100. * (count - 1))))
+            result['latency_ms']['p%d' % p] = 1e3 * latencies[index]
+        if self.frames:
+            result['frames_per_second'] = self.frames / self.seconds
+        return result
+
+
+def timestamps():
+    """Generate timestamps the way Controller does."""
+    while True:
+        for letter in string.ascii_letters:
+            yield ord(letter)
+
+
+def sync_sequential(port, count):
+    """SyncComm, one command after another."""
+    comm = SyncComm(port)
+    measurement = Measurement()
+    ts = timestamps()
+    with measurement:
+        for i in xrange(count):
+            t = ts.next()
+            comm.send_command('E%c\n' % t, t, 'e', measurement.timed(time.time()))
+    comm.serial_connection.close()
+    return measurement
+
+
+def async_sequential(port, count):
+    """AsyncComm, waiting for each response before sending next command."""
+    comm = AsyncComm(port)
+    comm.start()
+    measurement = Measurement()
+    ts = timestamps()
+    with measurement:
+        for i in xrange(count):
+            t = ts.next()
+            comm.send_command('E%c\n' % t, t, 'e', measurement.timed(time.time())).join()
+    comm.stop()
+    comm.join()
+    return measurement
+
+
+def async_pipelined(port, count, window=8):
+    """AsyncComm, keeping window commands waiting for the response."""
+    comm = AsyncComm(port)
+    comm.start()
+    measurement = Measurement()
+    ts = timestamps()
+    handlers = []
+    with measurement:
+        for i in xrange(count):
+            if len(handlers) >= window:
+                handlers.pop(0).join()
+            t = ts.next()
+            handlers.append(comm.send_command('E%c\n' % t, t, 'e',
+                                              measurement.timed(time.time())))
+        for handler in handlers:
+            handler.join()
+    comm.stop()
+    comm.join()
+    return measurement
+
+
+def loop_pipelined(port, count, window=8):
+    """LoopComm, keeping window commands waiting for the response."""
+    loop = EventLoop()
+    comm = LoopComm(port, loop)
+    measurement = Measurement()
+    ts = timestamps()
+    handlers = []
+    with measurement:
+        for i in xrange(count):
+            if len(handlers) >= window:
+                handlers.pop(0).join()
+            t = ts.next()
+            handlers.append(comm.send_command('E%c\n' % t, t, 'e',
+                                              measurement.timed(time.time())))
+        for handler in handlers:
+            handler.join()
+    comm.close()
+    return measurement
+
+
+def controller_sensors(port, count):
+    """Controller reading proximity sensors synchronously."""
+    controller = Controller(port)
+    measurement = Measurement()
+    with measurement:
+        for i in xrange(count):
+            controller.get_proximity_sensors(callback=measurement.timed(time.time()))
+    return measurement
+
+
+def controller_photos(port, count):
+    """Controller taking photos synchronously."""
+    controller = Controller(port)
+    measurement = Measurement()
+    with measurement:
+        for i in xrange(count):
+            controller.get_photo(callback=measurement.timed(time.time()))
+            measurement.frames += 1
+    return measurement
+
+
+def controller_nested(port, count, window=1):
+    """LoopComm controller, every callback sends a command with full window."""
+    controller = Controller(port, loop=EventLoop(), window=window)
+    measurement = Measurement()
+    with measurement:
+        for i in xrange(0, count, 2 * window):
+            inner = []
+            def _callback(response, sent_at=time.time()):
+                inner.append(controller.get_proximity_sensors(
+                    callback=measurement.timed(sent_at)))
+                return measurement.timed(sent_at)(response)
+            handlers = [controller.get_speed(callback=_callback)
+                        for j in xrange(window)]
+            for handler in handlers:
+                handler.get_response()
+            for handler in inner:
+                handler.get_response()
+    controller.comm.close()
+    return measurement
+
+
+def controller_stream(port, count):
+    """Controller streaming photos asynchronously."""
+    controller = Controller(port, asynchronous=True)
+    measurement = Measurement()
+    frames = controller.stream_photos()
+    with measurement:
+        for i in xrange(count):
+            frame = frames.next()
+            measurement.latencies.append(frame.received_at - frame.sent_at)
+            measurement.frames += 1
+    frames.close()
+    controller.comm.stop()
+    controller.comm.join()
+    return measurement
+
+
+# Stored are tuples (name, function, fraction of the command count).
+SCENARIOS = [
+    ('sync_sequential', sync_sequential, 1),
+    ('async_sequential', async_sequential, 1),
+    ('async_pipelined', async_pipelined, 1),
+    ('loop_pipelined', loop_pipelined, 1),
+    ('controller_sensors', controller_sensors, 1),
+    ('controller_photos', controller_photos, 0.1),
+    ('controller_nested', controller_nested, 1),
+    ('controller_stream', controller_stream, 0.1),
+]
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('-n', '--count', type='int', default=500,
+                      help='number of commands in each scenario')
+    parser.add_option('-b', '--bandwidth', type='int', default=None,
+                      help='bytes per second of the emulated link')
+    parser.add_option('-l', '--latency', type='float', default=0,
+                      help='one way latency of the emulated link in seconds')
+    parser.add_option('-o', '--output', default='comm-results.json',
+                      help='file where the results are saved')
+    options, names = parser.parse_args()
+
+    results = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'count': options.count,
+        'bandwidth': options.bandwidth,
+        'latency': options.latency,
+        'scenarios': {},
+    }
+
+    print '%-20s %8s %10s %9s %9s %9s %11s %8s' % (
+        'scenario', 'commands', 'cmd/s', 'p50 ms', 'p90 ms', 'p99 ms',
+        'cpu us/cmd', 'fps')
+    for name, function, fraction in SCENARIOS:
+        if names and name not in names:
+            continue
+        robot = Robot(options.bandwidth, options.latency)
+        try:
+            measurement = function(robot.port, max(1, int(options.count * fraction)))
+        finally:
+            robot.stop()
+
+        result = measurement.result()
+        results['scenarios'][name] = result
+        latency = result['latency_ms']
+        print '%-20s %8d %10.1f %9.2f %9.2f %9.2f %11.1f %8s' % (
+            name, result['commands'], result['commands_per_second'],
+            latency['p50'], latency['p90'], latency['p99'],
+            result['cpu_per_command_us'],
+            '%.1f' % result['frames_per_second'] if 'frames_per_second' in result else '-')
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print 'Results saved to %s' % options.output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measure the time the controller spends on one command.
+
+The commands are answered right away by ReplyingComm instead of the robot,
+so the measured time is only the work of the controller: allocating the
+timestamp, encoding the command and decoding the response.
+
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from epuck.controller import Controller
+from epuck.emulator import Emulator
+
+# Responses of the robot under the response codes. Binary responses with
+# fixed size are lists of parts, as the comm passes them to the callback.
+RESPONSES = {
+    'd': '', 'l': '', 'b': '', 'j': '', 't': '',
+    'i': '1,40,40,8,3200',
+    chr(256 - ord('E')): ['\x10\x00\x20\x00'],
+    chr(256 - ord('N')): ['\x01\x00' * 8],
+    chr(256 - ord('u')): ['\x01\x00' * 3],
+    chr(256 - ord('A')): '\x00\x00\x80\x3f' * 3,
+}
+
+SCENARIOS = [
+    ('set_speed', lambda c: c.set_speed(100, -100)),
+    ('set_led', lambda c: c.set_led(3, True)),
+    ('set_camera', lambda c: c.set_camera(1, 40, 40, 8)),
+    ('get_speed', lambda c: c.get_speed()),
+    ('get_proximity_sensors', lambda c: c.get_proximity_sensors()),
+    ('get_volume', lambda c: c.get_volume()),
+    ('get_accelerometer', lambda c: c.get_accelerometer()),
+    ('get_camera', lambda c: c.get_camera()),
+]
+
+
+class ReplyingComm(object):
+    """Answer every command at once with the response from RESPONSES."""
+
+    def __init__(self):
+        self.stats = None
+        self.recorder = None
+        self.timestamp = 0
+
+    def allocate_timestamp(self, blocking=True):
+        self.timestamp = self.timestamp % 254 + 1
+        return self.timestamp
+
+    def release_timestamp(self, timestamp):
+        pass
+
+    def send_command(self, command, timestamp, command_code, callback=lambda x: x,
+                     response_layout=None, coalesce_key=None):
+        return callback(RESPONSES[command_code])
+
+    def resolved(self, response, callback=lambda x: x):
+        return callback(response)
+
+
+def microseconds_per_call(controller, function, count):
+    start = time.time()
+    for i in xrange(count):
+        function(controller)
+    return (time.time() - start) / count * 1e6
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('-n', '--count', type='int', default=20000,
+                      help='number of calls in each scenario')
+    options, names = parser.parse_args()
+
+    emulator = Emulator()
+    emulator.start()
+    try:
+        controller = Controller(emulator.port)
+        controller.comm = ReplyingComm()
+
+        print '%-22s %10s' % ('command', 'us/call')
+        for name, function in SCENARIOS:
+            if names and name not in names:
+                continue
+            print '%-22s %10.2f' % (
+                name, microseconds_per_call(controller, function, options.count))
+    finally:
+        emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measure how many RGB565 frames per second can be decoded.
+
+The decoder used by Controller.get_photo is compared with the original
+implementation computing the colors pixel by pixel.
+
+"""
+
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from epuck import imaging
+
+RESOLUTIONS = [(40, 40), (80, 60), (160, 120), (320, 240)]
+
+
+def decode_per_pixel(image):
+    """The decoder used before the lookup table."""
+    ret = ""
+    data_struct = "<BBB"
+
+    for (hi, lo) in zip(image[0::2], image[1::2]):
+        val = (ord(hi) << 8) + ord(lo)
+        b = int(((val >> 11) & 31) / 31. * 255)
+        g = int(((val >> 5) & 63) / 63. * 255)
+        r = int((val & 31) / 31. * 255)
+        ret += struct.pack(data_struct, b, g, r)
+    return ret
+
+
+def frames_per_second(decode, data, duration=1.0):
+    """Decode the frame repeatedly for given time and return the rate."""
+    frames = 0
+    start = time.time()
+    while time.time() - start < duration:
+        decode(data)
+        frames += 1
+    return frames / (time.time() - start)
+
+
+def main():
+    # Build the lookup table before measuring.
+    imaging.rgb565_to_rgb('\x00\x00')
+
+    print '%-10s %15s %15s %8s' % ('size', 'per pixel fps', 'table fps', 'speedup')
+    for width, height in RESOLUTIONS:
+        data = os.urandom(width * height * 2)
+        assert decode_per_pixel(data) == imaging.rgb565_to_rgb(data)
+
+        old = frames_per_second(decode_per_pixel, data)
+        new = frames_per_second(imaging.rgb565_to_rgb, data)
+        print '%-10s %15.1f %15.1f %7.1fx' % ('%dx%d' % (width, height), old, new, new / old)
+
+
+if __name__ == '__main__':
+    main()
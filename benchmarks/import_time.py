@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measure how long it takes to import the library and how much memory.
+
+Every module is imported in a fresh interpreter several times, the median
+time, the growth of the resident memory and the number of imported modules
+are printed. The modules used without the camera must not import PIL, NumPy
+or the backends they don't use; the script exits with status 1 if they do,
+or if the median time exceeds the limit given by --max-ms.
+
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules imported by headless programs reading the sensors.
+MODULES = ['epuck', 'epuck.scheduler', 'epuck.telemetry', 'epuck.records']
+
+# Modules which must be imported only by programs using them.
+HEAVY = ['Image', 'PIL', 'numpy', 'decorator', 'serial',
+         'epuck.comm.async', 'epuck.comm.loop', 'epuck.comm.sync']
+
+MEASURE = """
+import json, resource, sys, time
+sys.path.insert(0, %(root)r)
+before = set(sys.modules)
+memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.time()
+import %(module)s
+elapsed = time.time() - start
+imported = [name for name in set(sys.modules) - before if sys.modules[name] is not None]
+print json.dumps({
+    'ms': elapsed * 1000,
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory,
+    'modules': sorted(imported),
+})
+"""
+
+
+def measure(module):
+    """Import the module in a new interpreter, return the measured values."""
+    code = MEASURE % {'root': ROOT, 'module': module}
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(output)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [module ...]')
+    parser.add_option('-n', '--repeat', type='int', default=11,
+                      help='number of imports of each module')
+    parser.add_option('--max-ms', type='float', default=None,
+                      help='fail if an import takes longer (median)')
+    options, modules = parser.parse_args()
+
+    failed = False
+    print '%-18s %8s %8s %8s  %s' % ('module', 'ms', 'rss kB', 'modules',
+                                     'heavy modules')
+    for module in modules or MODULES:
+        results = [measure(module) for i in range(options.repeat)]
+        heavy = [name for name in HEAVY if name in results[0]['modules']]
+        ms = median([result['ms'] for result in results])
+        print '%-18s %8.2f %8d %8d  %s' % (
+            module, ms, median([result['rss_kb'] for result in results]),
+            len(results[0]['modules']), ', '.join(heavy) or '-')
+        if heavy or (options.max_ms is not None and ms > options.max_ms):
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
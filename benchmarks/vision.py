@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measure how many photos per second can be filtered.
+
+The analysis of the bull example (blur, HSV conversion and red threshold)
+is compared with the original implementation working pixel by pixel with
+getpixel and putpixel.
+
+"""
+
+import functools
+import os
+import sys
+import time
+
+import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from epuck import vision
+
+RESOLUTIONS = [(40, 40), (100, 100), (160, 120)]
+
+
+def hue(r, g, b):
+    M = max(r, g, b)
+    m = min(r, g, b)
+    C = M - m
+
+    if C == 0:
+        return None
+    if M == r:
+        h = float(g-b)/C % 6
+    elif M == g:
+        h = float(b-r)/C + 2
+    elif M == b:
+        h = float(r-g)/C + 4
+
+    return h
+
+def saturation(r, g, b):
+    V = M = max(r,g,b)
+    m = min(r,g,b)
+    C = M - m
+    if C == 0:
+        return 0
+    else:
+        return float(C)/V
+
+def value(r, g, b):
+    return max(r, g, b) / 255.0
+
+def reduce_noise(image):
+    step = 2
+    for i in range(0, image.size[0]-step, step):
+        for j in range(0, image.size[1]-step, step):
+            pixels = [image.getpixel((i+x, j+y)) for x in range(step) for y in range(step)]
+            sum_pixels = functools.reduce(
+                lambda (r1,g1,b1), (r2,g2,b2): (r1+r2, g1+g2, b1+b2),
+                pixels)
+            avg_pixel = map(lambda x: x / (step * step), sum_pixels)
+
+            for x in range(step):
+                for y in range(step):
+                    image.putpixel((i+x, j+y), tuple(avg_pixel))
+
+def filter_red(image):
+    saturation_threshold = 0.4
+    value_threshold = 0.3
+    data = []
+    for (r,g,b) in image.getdata():
+        h = hue(r, g, b)
+        if (h < 0.3 or h > 5.7) \
+           and saturation(r, g, b) > saturation_threshold \
+           and value(r, g, b) > value_threshold:
+            data.append((255, 255, 255))
+        else:
+            data.append((0, 0, 0))
+
+    image.putdata(data)
+    return image
+
+
+def analyse_per_pixel(image):
+    """The analysis of the bull example before epuck.vision."""
+    image = image.copy()
+    reduce_noise(image)
+    return filter_red(image)
+
+
+def analyse_vectorized(image):
+    """The analysis of the bull example with epuck.vision."""
+    blurred = vision.box_blur(vision.to_array(image), radius=1)
+    hsv = vision.rgb_to_hsv(blurred)
+    red = vision.threshold(hsv, hue=(5.7, 0.3), saturation=(0.4, 1),
+                           value=(0.3, 1))
+    return vision.blob(red)
+
+
+def mask_agreement(image):
+    """Return the share of pixels both red filters agree on."""
+    old = vision.to_array(filter_red(image.copy()))[..., 0] > 0
+    hsv = vision.rgb_to_hsv(vision.to_array(image))
+    new = vision.threshold(hsv, hue=(5.7, 0.3), saturation=(0.4, 1),
+                           value=(0.3, 1))
+    return (old == new).mean()
+
+
+def frames_per_second(analyse, image, duration=1.0):
+    """Analyse the photo repeatedly for given time and return the rate."""
+    frames = 0
+    start = time.time()
+    while time.time() - start < duration:
+        analyse(image)
+        frames += 1
+    return frames / (time.time() - start)
+
+
+def main():
+    print '%-10s %15s %15s %8s %10s' % ('size', 'per pixel fps',
+                                        'vectorized fps', 'speedup', 'agreement')
+    for width, height in RESOLUTIONS:
+        image = Image.fromstring('RGB', (width, height),
+                                 os.urandom(width * height * 3))
+
+        old = frames_per_second(analyse_per_pixel, image)
+        new = frames_per_second(analyse_vectorized, image)
+        print '%-10s %15.1f %15.1f %7.1fx %9.1f%%' % (
+            '%dx%d' % (width, height), old, new, new / old,
+            100 * mask_agreement(image))
+
+
+if __name__ == '__main__':
+    main()
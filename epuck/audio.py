@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+
+
+def _numpy():
+    """Import NumPy, which is needed only by this module."""
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("NumPy is required for processing the microphone data.")
+    return numpy
+
+
+def decode_fft(response):
+    """Decode the FFT block sent by the robot into a complex NumPy array.
+
+    The robot sends the real and imaginary parts of every bin as signed
+    chars, one after another. The bytes are viewed as signed integers and
+    the pairs are reinterpreted as complex numbers without a Python loop.
+    The array doesn't share memory with the response.
+
+    """
+    numpy = _numpy()
+    if isinstance(response, memoryview):
+        # NumPy for Python 2 can't read memoryviews.
+        response = response.tobytes()
+    data = numpy.frombuffer(response, dtype=numpy.int8)
+    if len(data) % 2:
+        data = data[:-1]
+    return data.astype(numpy.float32).view(numpy.complex64)
+
+
+class Spectrogram(object):
+    """The last FFT blocks from the microphone in a rolling NumPy array.
+
+    The blocks are written into a preallocated array of shape (blocks,
+    bins), the oldest one is overwritten once it's full. The methods return
+    the blocks from the oldest to the newest.
+
+    Usage:
+        spectrogram = Spectrogram(blocks=100)
+        for block in controller.stream_microphone(spectrogram=spectrogram):
+            if len(spectrogram) == 100:
+                print spectrogram.peak_bin()
+
+    """
+
+    def __init__(self, blocks=128, bins=32):
+        numpy = _numpy()
+        self.blocks = blocks
+        self.bins = bins
+        self.data = numpy.zeros((blocks, bins), dtype=numpy.complex64)
+        self.times = numpy.zeros(blocks)
+        # Row where the next block is written.
+        self.position = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, block, timestamp=None):
+        """Store the FFT block (e.g. returned by decode_fft)."""
+        if timestamp is None:
+            timestamp = time.time()
+        n = min(len(block), self.bins)
+        row = self.data[self.position]
+        row[:n] = block[:n]
+        row[n:] = 0
+        self.times[self.position] = timestamp
+        self.position = (self.position + 1) % self.blocks
+        self.count = min(self.count + 1, self.blocks)
+
+    def clear(self):
+        """Forget all blocks."""
+        self.position = 0
+        self.count = 0
+
+    def spectrum(self):
+        """Return the complex array of the stored blocks in time order."""
+        numpy = _numpy()
+        if self.count < self.blocks:
+            return self.data[:self.count].copy()
+        return numpy.roll(self.data, -self.position, axis=0)
+
+    def timestamps(self):
+        """Return the times of the stored blocks in time order."""
+        numpy = _numpy()
+        if self.count < self.blocks:
+            return self.times[:self.count].copy()
+        return numpy.roll(self.times, -self.position)
+
+    def magnitude(self):
+        """Return the magnitudes of the stored blocks in time order."""
+        return abs(self.spectrum())
+
+    def mean_magnitude(self):
+        """Return the magnitude of every bin averaged over the stored blocks."""
+        if not self.count:
+            return None
+        return abs(self.data[:self.count]).mean(axis=0)
+
+    def peak_bin(self):
+        """Return the bin with the highest average magnitude, None if empty."""
+        magnitude = self.mean_magnitude()
+        if magnitude is None:
+            return None
+        return int(magnitude.argmax())
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+
+
+class StateCache(object):
+    """State of the robot read or set recently by the controller.
+
+    The values are served for ttl seconds since they were stored. Setting a
+    value invalidates the cached one right away and stores the new one once
+    the robot acknowledges the command, reads sent before that can't
+    overwrite it: every invalidation starts a new generation of the key and
+    only values of the current generation are stored.
+
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # Stored are tuples (value, time) under the keys.
+        self.values = {}
+        # Stored are numbers increased whenever the key is invalidated.
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached value or None if it's missing or too old."""
+        cached = self.values.get(key)
+        if cached is not None and time.time() - cached[1] <= self.ttl:
+            self.hits += 1
+            return cached[0]
+        self.misses += 1
+        return None
+
+    def generation(self, key):
+        """Return the current generation of the key."""
+        return self.generations.get(key, 0)
+
+    def put(self, key, value, generation=None):
+        """Store the value, unless it's from an older generation."""
+        if generation is not None and generation != self.generation(key):
+            return
+        self.values[key] = (value, time.time())
+
+    def invalidate(self, *keys):
+        """Forget the values of the keys, of all keys if none are given."""
+        if not keys:
+            keys = set(self.values) | set(self.generations)
+        for key in keys:
+            self.values.pop(key, None)
+            self.generations[key] = self.generation(key) + 1
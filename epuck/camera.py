@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import time
+
+from epuck.controller import Controller, ControllerError
+from epuck.records import record_type
+
+# Size of the camera picture in the buffer of the firmware (see BTcomDM.c),
+# larger pictures overwrite the memory behind it.
+CAMERA_BUFFER = 40 * 40 * 2
+# Size of the camera array, the picture is width * zoom x height * zoom.
+ARRAY_WIDTH = 640
+ARRAY_HEIGHT = 480
+# Bytes sent with every photo besides the pixels: response code, timestamp,
+# size of the response, mode, width and height.
+PHOTO_HEADER = 9
+
+# Camera configuration with the frame rate and the size of the photos
+# measured by CameraTuner.
+CameraSetting = record_type('CameraSetting',
+                            ['mode', 'width', 'height', 'zoom', 'fps', 'frame_bytes'])
+
+
+def bytes_per_pixel(mode):
+    """Return the number of bytes of one pixel sent in the mode."""
+    return 1 if mode == Controller.GREYSCALE_MODE else 2
+
+
+def candidates(modes=(Controller.RGB565_MODE, Controller.GREYSCALE_MODE),
+               zooms=(8, 4, 2), aspect=1.0, step=8, buffer_size=CAMERA_BUFFER):
+    """Return the camera configurations fitting into the firmware buffer.
+
+    The configurations are tuples (mode, width, height, zoom) with the
+    height a multiple of step and the width aspect times larger. They are
+    ordered from the highest resolution; of the same resolution color goes
+    before greyscale (in the order of modes) and larger zoom goes first.
+
+    """
+    configurations = []
+    for mode in modes:
+        for height in range(step, ARRAY_HEIGHT + 1, step):
+            width = int(round(height * aspect / step)) * step
+            if not width or width * height * bytes_per_pixel(mode) > buffer_size:
+                continue
+            for zoom in zooms:
+                if width * zoom <= ARRAY_WIDTH and height * zoom <= ARRAY_HEIGHT:
+                    configurations.append((mode, width, height, zoom))
+
+    def _rank(configuration):
+        mode, width, height, zoom = configuration
+        return (-width * height, list(modes).index(mode), -zoom)
+    return sorted(configurations, key=_rank)
+
+
+def _result(ret):
+    """Wait for the response if the command returned a handler."""
+    if hasattr(ret, 'get_response'):
+        return ret.get_response()
+    return ret
+
+
+class CameraTuner(object):
+    """Find the largest photos the robot can send at given frame rate.
+
+    The frame rate depends on the mode, the size and the zoom of the photos
+    and on the connection to the robot, so it's measured: the candidate
+    configurations are set by set_camera one by one, from the highest
+    resolution, and the photos taken by get_photo are timed until one of
+    them is fast enough. The chosen configuration is cached under the robot
+    (its port by default), so next time it's set without measuring. Give
+    path to keep the cache in a file across sessions.
+
+    Usage:
+        tuner = CameraTuner(controller, path='camera.json')
+        setting = tuner.tune(fps=2)
+        print setting['width'], setting['height'], setting['fps']
+
+    """
+
+    def __init__(self, controller, path=None, robot=None, frames=3):
+        """Create new tuner.
+
+        Arguments:
+            controller -- Controller of the robot.
+            path -- JSON file with the settings of the robots, None keeps
+                them in memory only.
+            robot -- Name of the robot in the cache, the port by default.
+            frames -- How many photos are timed for each configuration.
+
+        """
+        self.controller = controller
+        self.path = path
+        self.robot = robot if robot is not None else controller.port
+        self.frames = frames
+        # Stored are dictionaries of settings under the robots, the settings
+        # are stored under the keys made by _key.
+        self.settings = self._load()
+
+        self.logger = logging.getLogger('CameraTuner')
+
+    def _load(self):
+        """Read the cache file, start with an empty cache if there is none."""
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def _save(self):
+        """Write the cache file."""
+        if self.path is None:
+            return
+        with open(self.path, 'w') as f:
+            json.dump(self.settings, f, indent=2, sort_keys=True)
+
+    def _key(self, fps, modes, zooms, aspect):
+        return '%g fps, modes %s, zooms %s, aspect %g' % (
+            fps, ','.join(map(str, modes)), ','.join(map(str, zooms)), aspect)
+
+    def cached(self, fps, modes=(Controller.RGB565_MODE, Controller.GREYSCALE_MODE),
+               zooms=(8, 4, 2), aspect=1.0):
+        """Return the cached setting for the frame rate or None."""
+        key = self._key(fps, modes, zooms, aspect)
+        setting = self.settings.get(self.robot, {}).get(key)
+        if setting is None:
+            return None
+        return CameraSetting(setting)
+
+    def forget(self):
+        """Remove all cached settings of the robot."""
+        if self.settings.pop(self.robot, None) is not None:
+            self._save()
+
+    def measure(self, mode, width, height, zoom):
+        """Set the camera and return the CameraSetting with measured rate.
+
+        The first photo after the change isn't timed, it may still be taken
+        with the previous configuration.
+
+        """
+        _result(self.controller.set_camera(mode, width, height, zoom))
+        _result(self.controller.get_photo())
+
+        frame_bytes = 0
+        start = time.time()
+        for i in range(self.frames):
+            photo = _result(self.controller.get_photo())
+            if photo is None:
+                raise ControllerError("The robot didn't send the photo.")
+            frame_bytes += (photo.size[0] * photo.size[1] * bytes_per_pixel(mode)
+                            + PHOTO_HEADER)
+        elapsed = time.time() - start
+
+        setting = CameraSetting((mode, width, height, zoom, self.frames / elapsed,
+                                 frame_bytes // self.frames))
+        self.logger.debug("%r", setting)
+        return setting
+
+    def tune(self, fps, modes=(Controller.RGB565_MODE, Controller.GREYSCALE_MODE),
+             zooms=(8, 4, 2), aspect=1.0, force=False):
+        """Set the camera to the highest resolution taken at fps or faster.
+
+        The cached setting is used unless force is True. If no configuration
+        is fast enough, the fastest measured one is set. Return the
+        CameraSetting.
+
+        Arguments:
+            fps -- Required photos per second.
+            modes -- Allowed modes, preferred first.
+            zooms -- Allowed zoom factors, preferred first.
+            aspect -- Ratio of the width to the height of the photos.
+            force -- Set True to measure even if the setting is cached.
+
+        """
+        key = self._key(fps, modes, zooms, aspect)
+        setting = None if force else self.cached(fps, modes, zooms, aspect)
+        if setting is not None:
+            _result(self.controller.set_camera(*setting[:4]))
+            return setting
+
+        fastest = None
+        for configuration in candidates(modes, zooms, aspect):
+            measured = self.measure(*configuration)
+            if fastest is None or measured['fps'] > fastest['fps']:
+                fastest = measured
+            if measured['fps'] >= fps:
+                setting = measured
+                break
+        else:
+            if fastest is None:
+                raise ControllerError("No camera configuration fits the buffer.")
+            self.logger.warning("No camera configuration reaches %g fps.", fps)
+            setting = fastest
+            _result(self.controller.set_camera(*setting[:4]))
+
+        self.settings.setdefault(self.robot, {})[key] = list(setting)
+        self._save()
+        return setting
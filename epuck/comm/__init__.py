@@ -1,9 +1,10 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-__all__ = ['CommError']
+__all__ = ['CommError', 'RequestSuperseded']
 
-import socket
+import sys
+import types
 
 from epuck import EPuckError
 
@@ -14,7 +15,52 @@ class CommError(EPuckError):
     """
     pass
 
-from async import RequestHandler, AsyncCommError, AsyncComm
-from sync import SyncCommError, SyncComm
-from socketpair import create_socket_pair
+class RequestSuperseded(CommError):
+    """
+    The command was replaced by a newer one before it was sent.
+
+    """
+    pass
+
+# The backends are imported when they are first used, so importing the
+# package doesn't import pyserial, sockets and threads of backends nobody
+# uses. Stored are the submodules under the names they export.
+_LAZY_NAMES = {
+    'RequestHandler': 'async',
+    'AsyncCommError': 'async',
+    'AsyncComm': 'async',
+    'SyncCommError': 'sync',
+    'SyncComm': 'sync',
+    'LoopCommError': 'loop',
+    'LoopRequestHandler': 'loop',
+    'Task': 'loop',
+    'EventLoop': 'loop',
+    'LoopComm': 'loop',
+    'create_socket_pair': 'socketpair',
+}
+
+
+class _LazyPackage(types.ModuleType):
+    """The package importing the submodule of a name on the first access."""
+
+    def __getattr__(self, name):
+        try:
+            submodule = _LAZY_NAMES[name]
+        except KeyError:
+            raise AttributeError(name)
+        module = __import__('%s.%s' % (__name__, submodule), fromlist=[name])
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_LAZY_NAMES))
+
+
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(globals())
+# The functions and classes above use the globals of this module, it must
+# stay alive.
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
 
@@ -6,10 +6,18 @@ import os
 import Queue
 import select
 import serial
+import socket
 import threading
 import time
 
-from epuck.comm import CommError
+from epuck.comm import CommError, RequestSuperseded
+from epuck.comm.buffers import BufferPool, detach
+from epuck.comm.coalesce import UNASSIGNED, DeferredRequests, assign_timestamp
+from epuck.comm.pending import PendingRequests, ResponseLayouts
+from epuck.comm.rtt import RetransmissionTimer
+from epuck.comm.socketpair import create_socket_pair
+from epuck.comm.stats import binary_size
+from epuck.comm.window import InFlightWindow
 
 
 class AsyncCommError(CommError):
@@ -24,15 +32,25 @@ class RequestHandler(object):
 
     """
 
-    def __init__(self, command, response_code, timestamp, callback):
+    def __init__(self, command, response_code, timestamp, callback,
+                 response_layout=None):
         self.command = command
         self.timestamp = timestamp
         self.response_code = response_code
         self.callback = callback
+        self.response_layout = response_layout
         self.tries = 0
+        self.sent_at = None
+        # When the last try was written, see RetransmissionTimer.started.
+        self.written_at = None
+        # Whether nobody waits for the response, see cancel.
+        self.cancelled = False
         self.error = None
+        # InFlightWindow which gave the request its timestamp.
+        self.window = None
 
         self.response = None
+        self.finished = False
         self.accomplished = threading.Condition()
         self.logger = logging.getLogger('RequestHandler')
 
@@ -40,6 +58,15 @@ class RequestHandler(object):
         """Return the command that was sent."""
         return self.command
 
+    def cancel(self):
+        """Never send the request again.
+
+        The response is still accepted if it comes, otherwise the request
+        fails once it times out.
+
+        """
+        self.cancelled = True
+
     def own_response(self, code, timestamp):
         """Decide whether the code belongs to this request."""
         return code == self.response_code and self.timestamp == timestamp
@@ -50,20 +77,31 @@ class RequestHandler(object):
         Also notify all waiting for the request.
 
         """
-        self.response = self.callback(response)
-
-        self.accomplished.acquire()
-        self.accomplished.notify()
-        self.accomplished.release()
+        try:
+            self.response = detach(self.callback(response))
+        except Exception as e:
+            self.set_error(e)
+        else:
+            self._finish()
 
     def set_error(self, error):
         """Save the exception that occured during communication."""
         self.error = error
+        self._finish()
 
+    def _finish(self):
+        """Mark the request as done and notify all waiting for it."""
+        if self.window is not None:
+            self.window.release(self.timestamp)
         self.accomplished.acquire()
-        self.accomplished.notify()
+        self.finished = True
+        self.accomplished.notifyAll()
         self.accomplished.release()
 
+    def done(self):
+        """Return whether the request has been answered or failed."""
+        return self.finished
+
     def get_response(self):
         """Return the response."""
         if not self.response_received():
@@ -76,7 +114,7 @@ class RequestHandler(object):
 
     def response_received(self):
         """Return whether a response has been received."""
-        return self.response is not None
+        return self.finished and self.error is None
 
     def error_raised(self):
         """Return whether an exception occured."""
@@ -85,7 +123,8 @@ class RequestHandler(object):
     def join(self):
         """Wait until the response is received."""
         self.accomplished.acquire()
-        self.accomplished.wait()
+        while not self.finished:
+            self.accomplished.wait()
         self.accomplished.release()
 
         if self.error is not None:
@@ -101,29 +140,49 @@ class AsyncComm(threading.Thread):
 
     """
 
-    def __init__(self, port, timeout=0.5, max_tries=10, **kwargs):
+    def __init__(self, port, timeout=0.5, max_tries=10, window=16, **kwargs):
         threading.Thread.__init__(self)
         self.daemon = True
         self.interrupt = Queue.Queue()
 
+        # Writing to the wakeup socket interrupts the select in main loop.
+        self.wakeup_receiver, self.wakeup_sender = create_socket_pair()
+        self.wakeup_sender.setblocking(False)
+
         try:
             self.serial_connection = serial.Serial(port, timeout=timeout, **kwargs)
             self.serial_connection.write('\r')
         except serial.SerialException as e:
             raise AsyncCommError(e.message)
 
-        # Create queues for requests and responses.
-        # Stored are only the requests.
-        self.request_queue = Queue.Queue(100)
-        # Stored are tuples (time of insertion, request).
-        self.response_queue = Queue.PriorityQueue(100)
+        # Requests waiting to be sent.
+        self.request_queue = Queue.Queue()
+        # Requests waiting for a response.
+        self.pending = PendingRequests()
+        self.layouts = ResponseLayouts()
+        # At most window requests can wait for a response.
+        self.window = InFlightWindow(window)
+        # Requests waiting for a timestamp, see DeferredRequests.
+        self.deferred = DeferredRequests()
 
         # Requests that are older than timeout seconds must be sent again.
+        # The timeout is adapted to the measured round trip time.
         self.timeout = timeout
+        self.rtt = RetransmissionTimer(timeout)
 
         # Set the max limit of retries.
         self.max_tries = max_tries
 
+        # Binary responses are read into buffers from the pool.
+        self.buffer_pool = BufferPool()
+        self.borrowed_buffers = []
+        self.size_buffer = bytearray(2)
+
+        # CommStats recording the communication, None when disabled.
+        self.stats = None
+        # Recorder logging all responses, None when disabled.
+        self.recorder = None
+
         self.logger = logging.getLogger('AsyncComm')
 
     def start(self):
@@ -134,25 +193,61 @@ class AsyncComm(threading.Thread):
     def stop(self):
         """Stop the main loop."""
         self.interrupt.put("STOP")
+        self._wakeup()
 
     def run(self):
         """The main loop of the communication manager.
 
         Call select and wait till the robot sends something or the user has
-        some commands to send to the robot.
+        some commands to send to the robot. The select is given a timeout so
+        that the loop wakes up when the oldest request should be sent again.
 
         """
         self.logger.debug('Starting main loop.')
 
-        last_check = time.time()
+        inputs = [self.serial_connection, self.wakeup_receiver]
         while self.running:
-            if self.serial_connection.inWaiting() > 0:
-                self._read_response()
-            if not self.interrupt.empty():
+            readable, _, _ = select.select(inputs, [], [], self._select_timeout())
+            if self.serial_connection in readable:
+                while self.serial_connection.inWaiting() > 0:
+                    try:
+                        self._read_response()
+                    except AsyncCommError as e:
+                        # The request is sent again when it times out.
+                        self.logger.error(e)
+                        self._release_buffers()
+                        break
+            if self.wakeup_receiver in readable:
+                self.wakeup_receiver.recv(4096)
                 self._process_interrupt()
-            if time.time() - last_check > self.timeout:
+            if self._select_timeout() == 0:
                 self._check_requests_timeout()
-                last_check = time.time()
+            if self.deferred:
+                self._send_deferred()
+
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
+
+    def _select_timeout(self):
+        """Return how long the main loop can sleep.
+
+        The loop has to wake up when the oldest sent request times out. If
+        there are no requests waiting for a response, it can sleep until the
+        robot or the user wakes it up.
+
+        """
+        deadline = self.pending.next_deadline()
+        if deadline is None:
+            return None
+        return max(0, deadline - time.time())
+
+    def _wakeup(self):
+        """Interrupt the select in the main loop."""
+        try:
+            self.wakeup_sender.send('x')
+        except socket.error:
+            # The buffer is full, the main loop will wake up anyway.
+            pass
 
     def _stop_main_loop(self):
         """Stop the main loop."""
@@ -175,13 +270,82 @@ class AsyncComm(threading.Thread):
             c = self.interrupt.get()
             command_handlers[c]()
 
-    def send_command(self, command, timestamp, command_code, callback=lambda x: x):
-        """Create new request and notify the main loop."""
-        self.logger.debug('Sending new command. Command: "%s", code: "%s", timestamp: "%s".' % (command, command_code, timestamp))
-        request = RequestHandler(command, command_code, timestamp, callback)
-        self._enqueue_request(request)
+    def send_command(self, command, timestamp, command_code, callback=lambda x: x,
+                     response_layout=None, coalesce_key=None):
+        """Create new request and notify the main loop.
+
+        The response_layout describes the parts of a binary response, see
+        _read_binary_data.
+
+        A command with UNASSIGNED timestamp is deferred under the
+        coalesce_key until a timestamp is free, see DeferredRequests.
+
+        """
+        self.logger.debug('Sending new command. Command: "%s", code: "%s", timestamp: "%s".', command, command_code, timestamp)
+        request = RequestHandler(command, command_code, timestamp, callback,
+                                 response_layout)
+        request.window = self.window
+        if timestamp == UNASSIGNED:
+            self._defer_request(coalesce_key, request)
+        else:
+            self._enqueue_request(request)
         return request
 
+    def resolved(self, response, callback=lambda x: x):
+        """Return a finished handler of a command answered without the robot."""
+        request = RequestHandler(None, None, None, callback)
+        request.set_response(response)
+        return request
+
+    def allocate_timestamp(self, blocking=True):
+        """Return a timestamp for a new command.
+
+        Block while the window of requests waiting for a response is full,
+        if blocking is False return None instead. The timestamp is given
+        back when the request is done.
+
+        A callback runs in the thread which gives the timestamps back, so
+        it never blocks: the command it sends is deferred instead. While
+        some commands are deferred, a blocking call also waits until they
+        are sent and a non-blocking one returns None, so the new command
+        doesn't overtake them.
+
+        """
+        if not blocking or threading.current_thread() is self:
+            if self.deferred:
+                return None
+            return self.window.acquire(False)
+        return self.window.acquire(ready=lambda: not self.deferred)
+
+    def release_timestamp(self, timestamp):
+        """Give back the timestamp that hasn't been used for a request."""
+        self.window.release(timestamp)
+        if self.deferred:
+            self._wakeup()
+
+    def _defer_request(self, key, request):
+        """Let the request wait for a timestamp, supersede the older one."""
+        superseded = self.deferred.add(key, request)
+        if superseded is not None:
+            if self.stats is not None:
+                self.stats.superseded(superseded.response_code)
+            superseded.set_error(RequestSuperseded("Replaced by a newer command."))
+        self._wakeup()
+
+    def _send_deferred(self):
+        """Send the deferred requests while there are free timestamps."""
+        while self.deferred:
+            timestamp = self.window.acquire(False)
+            if timestamp is None:
+                break
+            request = self.deferred.pop()
+            assign_timestamp(request, timestamp)
+            self.request_queue.put(request)
+            self._write_request()
+        if not self.deferred:
+            # The commands waiting for the deferred ones can be sent.
+            self.window.changed()
+
     def _write_request(self):
         """Write the request to the serial connection."""
         # Remove the request from queue.
@@ -189,13 +353,23 @@ class AsyncComm(threading.Thread):
 
         # Send the request to the robot.
         command = request.get_command()
+        self.layouts.add(request.response_code, request.timestamp,
+                         request.response_layout)
         self.serial_connection.write(command)
 
-        # Add the request to another queue to wait for response.
-        try:
-            self.response_queue.put((time.time(), request), False)
-        except Queue.Full:
-            raise AsyncCommError("Too many requests.")
+        now = time.time()
+        if request.tries == 0:
+            request.sent_at = now
+        request.written_at = now
+        if self.stats is not None:
+            self.stats.sent(request.response_code, len(command), request.tries > 0)
+            self.stats.queued(self.request_queue.qsize(), len(self.pending) + 1)
+
+        # Wait for the response until the timeout.
+        replaced = self.pending.add(request, self.rtt.deadline(request))
+        if replaced is not None:
+            self.logger.error("Request with the same timestamp is still waiting.")
+            replaced.set_error(AsyncCommError("Request has been replaced."))
 
     def _read_response(self):
         """Read a response and save it."""
@@ -205,12 +379,16 @@ class AsyncComm(threading.Thread):
             # Binary data
             if ord(code) >= 127:
                 timestamp = ord(self.serial_connection.read(1))
-                response = self._read_binary_data()
-                self.logger.debug('Response: [%s]' % response)
+                layout = self.layouts.get(code, timestamp)
+                response = self._read_binary_data(layout)
+                size = binary_size(response, layout)
+                self.logger.debug('Response: [%s]', response)
             # Text data
             else:
-                response = self._read_text_data().split(',', 1)
-                self.logger.debug('Response: [%s]' % response)
+                data = self._read_text_data()
+                size = 1 + len(data)
+                response = data.split(',', 1)
+                self.logger.debug('Response: [%s]', response)
                 timestamp = ord(response[0][0])
                 try:
                     response = response[1]
@@ -219,27 +397,73 @@ class AsyncComm(threading.Thread):
         except TypeError as e:
             raise AsyncCommError("No response received: "+str(e))
 
+        if self.recorder is not None:
+            self.recorder.record(code, timestamp, response)
+
         if code == 'z':
             # Command not found
+            if self.stats is not None:
+                self.stats.unknown_command(size)
             return
 
 
-        self.logger.debug('Received response. Code: "%s", timestamp: "%s", response: "%s".' % (code, timestamp, response))
+        self.logger.debug('Received response. Code: "%s", timestamp: "%s", response: "%s".', code, timestamp, response)
 
-        self._save_response(code, timestamp, response)
+        try:
+            self._save_response(code, timestamp, response, size)
+        finally:
+            self._release_buffers()
 
 
-    def _read_binary_data(self):
+    def _read_binary_data(self, layout=None):
         """Read binary data from the robot.
 
         Some responses are binary. The robot first sends 2 bytes containing the
         size of the data. The data then follows.
 
+        The answer to several binary commands sent in one packet is made of
+        several parts. The layout is then a list of their sizes, None stands
+        for a part that starts with its own size. A list of the parts is
+        returned.
+
         """
-        lo, hi = self.serial_connection.read(2)
-        size = (ord(hi) << 8) + ord(lo)
-        data = self.serial_connection.read(size)
-        return data
+        if layout is None:
+            return self._read_binary_part(None)
+        return [self._read_binary_part(size) for size in layout]
+
+    def _read_binary_part(self, size):
+        """Read one part of binary data, possibly preceded by its size.
+
+        The data are read into a buffer borrowed from the pool and a
+        memoryview of them is returned. The buffers are given back by
+        _release_buffers once the response has been processed.
+
+        """
+        if size is None:
+            self._read_into(memoryview(self.size_buffer))
+            size = self.size_buffer[0] + (self.size_buffer[1] << 8)
+
+        buffer = self.buffer_pool.acquire(size)
+        self.borrowed_buffers.append(buffer)
+        return self._read_into(memoryview(buffer)[:size])
+
+    def _read_into(self, view):
+        """Fill the view with data from the robot and return it.
+
+        Raise AsyncCommError if it hasn't been filled before timeout.
+
+        """
+        received = self.serial_connection.readinto(view)
+        if received != len(view):
+            raise AsyncCommError("Response has been cut off, received %d of %d bytes."
+                     % (received, len(view)))
+        return view
+
+    def _release_buffers(self):
+        """Return the borrowed buffers to the pool."""
+        for buffer in self.borrowed_buffers:
+            self.buffer_pool.release(buffer)
+        self.borrowed_buffers = []
 
     def _read_text_data(self):
         """Read a text response from the robot.
@@ -250,25 +474,28 @@ class AsyncComm(threading.Thread):
         data = self.serial_connection.readline()
         return data
 
-    def _save_response(self, code, timestamp, response):
+    def _save_response(self, code, timestamp, response, size=0):
         """Find the right request and give it the response."""
-        request = self._get_request(code, timestamp)
-        if request is not None:
+        request = self.pending.pop(code, timestamp)
+        self.rtt.received(request, time.time())
+        if self.stats is not None:
+            self._record_response(request, code, response, size)
+        elif request is not None:
             request.set_response(response)
+        else:
+            self.logger.debug('No request is waiting for the response.')
+
+    def _record_response(self, request, code, response, size):
+        """Give the request the response and record the statistics."""
+        received_at = time.time()
+        if request is None:
+            self.stats.unexpected_response(size)
+            self.logger.debug('No request is waiting for the response.')
+            return
 
-    def _get_request(self, code, timestamp):
-        """Find the right request for given response code."""
-        while not self.response_queue.empty():
-            sent_time, first_request = self.response_queue.get()
-
-            if first_request.own_response(code, timestamp):
-                return first_request
-            else:
-                # E-puck process tasks synchronously, that means this request
-                # hasn't been sent.
-                self._enqueue_request(first_request)
-
-        return None
+        self.stats.received(code, size, received_at - request.sent_at)
+        request.set_response(response)
+        self.stats.callback_finished(code, time.time() - received_at)
 
     def _check_requests_timeout(self):
         """Check if requests are not waiting too long.
@@ -277,32 +504,32 @@ class AsyncComm(threading.Thread):
         message was lost and send it again.
 
         """
-        old_requests = True
-        while old_requests and not self.response_queue.empty():
-            sent_time, request = self.response_queue.get()
-            if time.time() - sent_time > self.timeout:
-                if request.tries < self.max_tries:
-                    request.tries += 1
-                    self._enqueue_request(request)
-                    self.logger.debug("Timeout exceeded: Sending command again: %s" % request.command)
-                else:
-                    self.logger.error("Max limit exceeded.")
-                    request.set_error(AsyncCommError("Max limit exceeded."))
+        now = time.time()
+        for request in self.pending.pop_expired(now):
+            deadline = self.rtt.deadline(request)
+            if deadline > now:
+                # Responses arrived meanwhile, it waited behind other requests.
+                self.pending.add(request, deadline)
+                continue
+            if self.stats is not None:
+                self.stats.timed_out(request.response_code)
+            if request.cancelled:
+                request.set_error(AsyncCommError("Request has been cancelled."))
+            elif request.tries < self.max_tries:
+                request.tries += 1
+                self._enqueue_request(request)
+                self.logger.debug("Timeout exceeded: Sending command again: %s" % request.command)
             else:
-                try:
-                    self.response_queue.put((sent_time, request), False)
-                except Queue.Full:
-                    self.logger.error("Too many requests.")
-                    request.error = AsyncCommError("Too many requests.")
-                old_requests = False
+                self.logger.error("Max limit exceeded.")
+                if self.stats is not None:
+                    self.stats.failed(request.response_code)
+                request.set_error(AsyncCommError("Max limit exceeded."))
 
     def _enqueue_request(self, request):
         "Put the request into the request_queue and notify the main loop."""
-        try:
-            self.request_queue.put(request, False)
-        except Queue.Full:
-            raise AsyncCommError("Too many requests.")
+        self.request_queue.put(request)
         self.interrupt.put("NEW")
+        self._wakeup()
 
 
 # Test the module.
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+class BufferPool(object):
+    """Preallocated buffers for binary responses.
+
+    Photos and FFT data come at high rate, reading every one of them into a
+    new string keeps the allocator busy. The buffers are instead borrowed from
+    the pool, the data are read into them and they are returned once the
+    response has been processed.
+
+    Buffers are grouped by their size rounded up to a power of two.
+
+    """
+
+    MIN_SIZE = 64
+
+    def __init__(self, max_free=4):
+        # Stored are lists of free buffers under their size.
+        self.free = {}
+        self.max_free = max_free
+
+    def acquire(self, size):
+        """Return a buffer of at least given size."""
+        capacity = self.MIN_SIZE
+        while capacity < size:
+            capacity <<= 1
+
+        try:
+            return self.free[capacity].pop()
+        except (KeyError, IndexError):
+            return bytearray(capacity)
+
+    def release(self, buffer):
+        """Return the buffer to the pool."""
+        free = self.free.setdefault(len(buffer), [])
+        if len(free) < self.max_free:
+            free.append(buffer)
+
+
+def detach(response):
+    """Copy the response out of the pooled buffers.
+
+    Memoryviews (also in a list) are converted to strings, anything else is
+    returned as it is.
+
+    """
+    if isinstance(response, memoryview):
+        return response.tobytes()
+    if isinstance(response, list):
+        return [detach(part) for part in response]
+    return response
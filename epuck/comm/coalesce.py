@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+
+# Timestamp of a command which waits for a free one, see DeferredRequests.
+UNASSIGNED = 0
+
+
+def assign_timestamp(request, timestamp):
+    """Give the deferred request its timestamp.
+
+    The timestamp is the second byte of every command, text or binary.
+
+    """
+    request.timestamp = timestamp
+    request.command = request.command[0] + chr(timestamp) + request.command[2:]
+
+
+class DeferredRequests(object):
+    """Commands setting the state of the robot which wait to be sent.
+
+    When the window of commands waiting for a response is full, a command
+    setting e.g. the speed doesn't wait for a timestamp in the caller.
+    It waits here under its coalesce key instead and a newer command with
+    the same key takes its place, only the latest state is worth sending.
+    The replaced command is superseded and never sent.
+
+    The commands are sent in the order they were deferred, the newer command
+    goes to the end in place of the replaced one. So the robot gets them in
+    the order they were called, e.g. the speed set after a stop isn't sent
+    before the stop. A command without a coalesce key (None) is never
+    replaced.
+
+    """
+
+    def __init__(self):
+        # Stored are requests under their coalesce keys.
+        self.requests = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, key, request):
+        """Defer the request.
+
+        Return the request which was waiting with the same key and has been
+        superseded, otherwise None.
+
+        """
+        if key is None:
+            key = object()
+        with self.lock:
+            superseded = self.requests.pop(key, None)
+            self.requests[key] = request
+        return superseded
+
+    def pop(self):
+        """Remove and return the oldest deferred request, None if empty."""
+        with self.lock:
+            if not self.requests:
+                return None
+            return self.requests.popitem(last=False)[1]
@@ -0,0 +1,621 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import select
+import serial
+import time
+
+from epuck.comm import CommError, RequestSuperseded
+from epuck.comm.coalesce import UNASSIGNED, DeferredRequests, assign_timestamp
+from epuck.comm.pending import PendingRequests, ResponseLayouts
+from epuck.comm.rtt import RetransmissionTimer
+from epuck.comm.window import InFlightWindow
+
+
+class LoopCommError(CommError):
+    """An error occured during the communication driven by event loop."""
+    pass
+
+
+class LoopRequestHandler(object):
+    """Represent the request sent by LoopComm.
+
+    The handler has the same interface as RequestHandler, but it doesn't use
+    any locks. Waiting for the response runs the event loop in the current
+    thread. Inside a task the handler should be yielded instead, the task is
+    resumed with the response.
+
+    """
+
+    def __init__(self, loop, command, response_code, timestamp, callback,
+                 response_layout=None):
+        self.loop = loop
+        self.command = command
+        self.timestamp = timestamp
+        self.response_code = response_code
+        self.callback = callback
+        self.response_layout = response_layout
+        self.tries = 0
+        self.sent_at = None
+        # When the last try was written, see RetransmissionTimer.started.
+        self.written_at = None
+        # Whether nobody waits for the response, see cancel.
+        self.cancelled = False
+        self.error = None
+        # InFlightWindow which gave the request its timestamp.
+        self.window = None
+
+        self.response = None
+        self.finished = False
+        self.callbacks = []
+
+    def get_command(self):
+        """Return the command that was sent."""
+        return self.command
+
+    def cancel(self):
+        """Never send the request again.
+
+        The response is still accepted if it comes, otherwise the request
+        fails once it times out.
+
+        """
+        self.cancelled = True
+
+    def own_response(self, code, timestamp):
+        """Decide whether the code belongs to this request."""
+        return code == self.response_code and self.timestamp == timestamp
+
+    def set_response(self, response):
+        """Set the response to the sent request."""
+        # The callback may send another command, it can use the timestamp.
+        self._release_timestamp()
+        try:
+            self.response = self.callback(response)
+        except Exception as e:
+            self.set_error(e)
+        else:
+            self._finish()
+
+    def set_error(self, error):
+        """Save the exception that occured during communication."""
+        self.error = error
+        self._finish()
+
+    def _release_timestamp(self):
+        """Give the timestamp back to the window, only once."""
+        if self.window is not None:
+            self.window.release(self.timestamp)
+            self.window = None
+
+    def _finish(self):
+        """Mark the request as done and schedule the callbacks."""
+        self._release_timestamp()
+        self.finished = True
+        for callback in self.callbacks:
+            self.loop.call_soon(callback, self)
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        """Call the callback with this handler once it is done."""
+        if self.finished:
+            self.loop.call_soon(callback, self)
+        else:
+            self.callbacks.append(callback)
+
+    def done(self):
+        """Return whether the request has been answered or failed."""
+        return self.finished
+
+    def get_response(self):
+        """Return the response, run the event loop until it is received."""
+        if not self.finished:
+            self.loop.run_until_complete(self)
+
+        if self.error is not None:
+            raise self.error
+
+        return self.response
+
+    def response_received(self):
+        """Return whether a response has been received."""
+        return self.finished and self.error is None
+
+    def error_raised(self):
+        """Return whether an exception occured."""
+        return self.error is not None
+
+    def join(self):
+        """Run the event loop until the response is received."""
+        self.get_response()
+
+
+class Task(object):
+    """Coroutine driven by the event loop.
+
+    The coroutine is a generator yielding request handlers, other tasks or
+    lists of them. The generator is resumed with the response (or a list of
+    responses) once they are received, errors are thrown into the generator.
+    The generator can end with raise StopIteration(value) to set the result
+    of the task.
+
+    The task has the same interface as LoopRequestHandler, so it can be
+    yielded by other tasks.
+
+    """
+
+    def __init__(self, loop, generator):
+        self.loop = loop
+        self.generator = generator
+        self.error = None
+        self.response = None
+        self.finished = False
+        self.callbacks = []
+
+        self.loop.call_soon(self._step)
+
+    def _step(self, value=None, error=None):
+        """Resume the generator with the value or the error."""
+        try:
+            if error is not None:
+                awaited = self.generator.throw(error)
+            else:
+                awaited = self.generator.send(value)
+        except StopIteration as e:
+            self.response = e.args[0] if e.args else None
+            self._finish()
+        except Exception as e:
+            self.error = e
+            self._finish()
+        else:
+            self._wait(awaited)
+
+    def _wait(self, awaited):
+        """Resume the generator once the awaited handlers are done."""
+        many = isinstance(awaited, (list, tuple))
+        handlers = list(awaited) if many else [awaited]
+        remaining = [len(handlers)]
+
+        def _handler_done(handler):
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+            errors = [h.error for h in handlers if h.error is not None]
+            if errors:
+                self._step(error=errors[0])
+            elif many:
+                self._step([h.response for h in handlers])
+            else:
+                self._step(handlers[0].response)
+
+        if not handlers:
+            self.loop.call_soon(self._step, [])
+        for handler in handlers:
+            handler.add_callback(_handler_done)
+
+    def _finish(self):
+        """Mark the task as done and schedule the callbacks."""
+        self.finished = True
+        for callback in self.callbacks:
+            self.loop.call_soon(callback, self)
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        """Call the callback with this task once it is done."""
+        if self.finished:
+            self.loop.call_soon(callback, self)
+        else:
+            self.callbacks.append(callback)
+
+    def done(self):
+        """Return whether the task has finished."""
+        return self.finished
+
+    def get_response(self):
+        """Return the result, run the event loop until the task finishes."""
+        if not self.finished:
+            self.loop.run_until_complete(self)
+
+        if self.error is not None:
+            raise self.error
+
+        return self.response
+
+    def response_received(self):
+        """Return whether the task has finished without an error."""
+        return self.finished and self.error is None
+
+    def error_raised(self):
+        """Return whether an exception occured."""
+        return self.error is not None
+
+    def join(self):
+        """Run the event loop until the task finishes."""
+        self.get_response()
+
+
+class EventLoop(object):
+    """Drive any number of LoopComm connections in one thread.
+
+    The loop waits in select for responses of all registered connections and
+    wakes up when the earliest request should be sent again. There are no
+    threads or locks, all callbacks run in the thread running the loop.
+
+    """
+
+    def __init__(self):
+        self.comms = []
+        # Stored are tuples (function, arguments).
+        self.ready = collections.deque()
+        self.running = False
+        # How many run_once calls are handling responses and callbacks.
+        self.dispatching = 0
+
+        self.logger = logging.getLogger('EventLoop')
+
+    def register(self, comm):
+        """Start waiting for responses on the connection."""
+        self.comms.append(comm)
+
+    def unregister(self, comm):
+        """Stop waiting for responses on the connection."""
+        self.comms.remove(comm)
+
+    def call_soon(self, function, *args):
+        """Call the function in the next iteration of the loop."""
+        self.ready.append((function, args))
+
+    def spawn(self, generator):
+        """Run the generator as a task, see Task."""
+        return Task(self, generator)
+
+    def gather(self, *handlers):
+        """Return a task finishing with the list of responses."""
+        def _gather():
+            responses = yield list(handlers)
+            raise StopIteration(responses)
+        return self.spawn(_gather())
+
+    def run_once(self, timeout=None):
+        """Wait for responses and run the callbacks that are ready."""
+        if self.ready:
+            timeout = 0
+        else:
+            deadline = self._next_deadline()
+            if deadline is not None:
+                wait = max(0, deadline - time.time())
+                timeout = wait if timeout is None else min(timeout, wait)
+
+        if self.comms:
+            readable, _, _ = select.select(self.comms, [], [], timeout)
+        else:
+            readable = []
+            if timeout:
+                time.sleep(timeout)
+
+        self.dispatching += 1
+        try:
+            for comm in readable:
+                comm.handle_read()
+
+            now = time.time()
+            for comm in self.comms:
+                comm.check_timeouts(now)
+
+            ready, self.ready = self.ready, collections.deque()
+            for function, args in ready:
+                function(*args)
+        finally:
+            self.dispatching -= 1
+
+    def run_until_complete(self, handler):
+        """Run the loop until the handler or task is done.
+
+        Return its response.
+
+        """
+        if not hasattr(handler, 'done'):
+            handler = self.spawn(handler)
+
+        while not handler.done():
+            if not self.ready and self._next_deadline() is None:
+                raise LoopCommError("Nothing to wait for.")
+            self.run_once()
+
+        return handler.get_response()
+
+    def run_forever(self):
+        """Run the loop until stop is called."""
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        """Stop the loop started by run_forever."""
+        self.running = False
+
+    def _next_deadline(self):
+        """Return the earliest deadline of all connections."""
+        deadlines = [d for d in (comm.next_deadline() for comm in self.comms)
+                     if d is not None]
+        return min(deadlines) if deadlines else None
+
+
+class LoopComm(object):
+    """Manage the communication with the robot in an event loop.
+
+    The commands are written to the robot immediately and the handlers are
+    resolved when the loop reads the responses. Many robots can share one
+    loop, which then needs only one thread.
+
+    """
+
+    def __init__(self, port, loop, timeout=0.5, max_tries=10, window=16, **kwargs):
+        try:
+            self.serial_connection = serial.Serial(port, timeout=timeout, **kwargs)
+            self.serial_connection.write('\r')
+        except serial.SerialException as e:
+            raise LoopCommError(e.message)
+
+        self.loop = loop
+        self.loop.register(self)
+
+        # Received data which don't form a whole response yet.
+        self.incoming = ''
+        # Requests waiting for a response.
+        self.pending = PendingRequests()
+        self.layouts = ResponseLayouts()
+        # At most window requests can wait for a response.
+        self.window = InFlightWindow(window)
+        # Requests waiting for a timestamp, see DeferredRequests.
+        self.deferred = DeferredRequests()
+
+        # Requests that are older than timeout seconds must be sent again.
+        # The timeout is adapted to the measured round trip time.
+        self.timeout = timeout
+        self.rtt = RetransmissionTimer(timeout)
+
+        # Set the max limit of retries.
+        self.max_tries = max_tries
+
+        # CommStats recording the communication, None when disabled.
+        self.stats = None
+        # Recorder logging all responses, None when disabled.
+        self.recorder = None
+
+        self.logger = logging.getLogger('LoopComm')
+
+    def fileno(self):
+        """Return the file descriptor of the serial connection."""
+        return self.serial_connection.fileno()
+
+    def close(self):
+        """Stop the communication with the robot."""
+        self.loop.unregister(self)
+        self.serial_connection.close()
+
+    def send_command(self, command, timestamp, command_code, callback=lambda x: x,
+                     response_layout=None, coalesce_key=None):
+        """Send the command and return its handler.
+
+        The response_layout describes the parts of a binary response, see
+        AsyncComm._read_binary_data.
+
+        A command with UNASSIGNED timestamp is deferred under the
+        coalesce_key until a timestamp is free, see DeferredRequests.
+
+        """
+        self.logger.debug('Sending new command. Command: "%s", code: "%s", timestamp: "%s".', command, command_code, timestamp)
+        request = LoopRequestHandler(self.loop, command, command_code,
+                                     timestamp, callback, response_layout)
+        request.window = self.window
+        if timestamp == UNASSIGNED:
+            self._defer_request(coalesce_key, request)
+        else:
+            self._write_request(request)
+        return request
+
+    def resolved(self, response, callback=lambda x: x):
+        """Return a finished handler of a command answered without the robot."""
+        request = LoopRequestHandler(self.loop, None, None, None, callback)
+        request.set_response(response)
+        return request
+
+    def allocate_timestamp(self, blocking=True):
+        """Return a timestamp for a new command.
+
+        While the window of requests waiting for a response is full, run the
+        event loop, if blocking is False return None instead. The timestamp
+        is given back when the request is done.
+
+        A callback run by the loop never runs the loop again (it would parse
+        the responses it is called from), the command it sends is deferred
+        instead if the window is full.
+
+        While some commands are deferred, a blocking call also runs the loop
+        until they are sent and a non-blocking one returns None, so the new
+        command doesn't overtake them.
+
+        """
+        if not blocking or self.loop.dispatching:
+            if self.deferred:
+                return None
+            return self.window.acquire(False)
+        while True:
+            if not self.deferred:
+                timestamp = self.window.acquire(False)
+                if timestamp is not None:
+                    return timestamp
+            self.loop.run_once()
+
+    def release_timestamp(self, timestamp):
+        """Give back the timestamp that hasn't been used for a request."""
+        self.window.release(timestamp)
+        self._send_deferred()
+
+    def _defer_request(self, key, request):
+        """Let the request wait for a timestamp, supersede the older one."""
+        superseded = self.deferred.add(key, request)
+        if superseded is not None:
+            if self.stats is not None:
+                self.stats.superseded(superseded.response_code)
+            superseded.set_error(RequestSuperseded("Replaced by a newer command."))
+        self._send_deferred()
+
+    def _send_deferred(self):
+        """Send the deferred requests while there are free timestamps."""
+        while self.deferred:
+            timestamp = self.window.acquire(False)
+            if timestamp is None:
+                break
+            request = self.deferred.pop()
+            assign_timestamp(request, timestamp)
+            self._write_request(request)
+
+    def _write_request(self, request):
+        """Write the request to the serial connection."""
+        command = request.get_command()
+        self.layouts.add(request.response_code, request.timestamp,
+                         request.response_layout)
+        self.serial_connection.write(command)
+
+        now = time.time()
+        if request.tries == 0:
+            request.sent_at = now
+        request.written_at = now
+        if self.stats is not None:
+            self.stats.sent(request.response_code, len(command), request.tries > 0)
+            self.stats.queued(0, len(self.pending) + 1)
+
+        replaced = self.pending.add(request, self.rtt.deadline(request))
+        if replaced is not None:
+            self.logger.error("Request with the same timestamp is still waiting.")
+            replaced.set_error(LoopCommError("Request has been replaced."))
+
+    def next_deadline(self):
+        """Return when the oldest request should be sent again."""
+        return self.pending.next_deadline()
+
+    def check_timeouts(self, now):
+        """Send again the requests waiting longer than the timeout limit.
+
+        Also send the deferred requests if some timestamps have been freed.
+
+        """
+        for request in self.pending.pop_expired(now):
+            deadline = self.rtt.deadline(request)
+            if deadline > now:
+                # Responses arrived meanwhile, it waited behind other requests.
+                self.pending.add(request, deadline)
+                continue
+            if self.stats is not None:
+                self.stats.timed_out(request.response_code)
+            if request.cancelled:
+                request.set_error(LoopCommError("Request has been cancelled."))
+            elif request.tries < self.max_tries:
+                request.tries += 1
+                self.logger.debug("Timeout exceeded: Sending command again: %s" % request.command)
+                self._write_request(request)
+            else:
+                self.logger.error("Max limit exceeded.")
+                if self.stats is not None:
+                    self.stats.failed(request.response_code)
+                request.set_error(LoopCommError("Max limit exceeded."))
+        self._send_deferred()
+
+    def handle_read(self):
+        """Read available data and process the whole responses."""
+        waiting = self.serial_connection.inWaiting()
+        self.incoming += self.serial_connection.read(max(waiting, 1))
+
+        position = 0
+        while position < len(self.incoming):
+            response = self._parse_response(self.incoming, position)
+            if response is None:
+                break
+            size = response[0] - position
+            position, code, timestamp, data = response
+            if self.recorder is not None and code is not None:
+                self.recorder.record(code, timestamp, data)
+            if code is None or code == 'z':
+                # Garbage or command not found
+                if self.stats is not None and code == 'z':
+                    self.stats.unknown_command(size)
+                elif self.stats is not None:
+                    self.stats.bytes_in += size
+                continue
+
+            self.logger.debug('Received response. Code: "%s", timestamp: "%s", response: "%s".', code, timestamp, data)
+            self._save_response(code, timestamp, data, size)
+
+        self.incoming = self.incoming[position:]
+
+    def _parse_response(self, data, position):
+        """Parse the response starting at given position.
+
+        Return tuple (end of the response, code, timestamp, response) or None
+        if the response hasn't been received whole yet.
+
+        """
+        code = data[position]
+        if code in '\r\n':
+            return (position + 1, None, None, None)
+
+        # Binary data
+        if ord(code) >= 127:
+            if position + 2 > len(data):
+                return None
+            timestamp = ord(data[position + 1])
+            layout = self.layouts.get(code, timestamp)
+
+            end = position + 2
+            parts = []
+            for size in layout if layout is not None else [None]:
+                if size is None:
+                    if end + 2 > len(data):
+                        return None
+                    size = ord(data[end]) + (ord(data[end + 1]) << 8)
+                    end += 2
+                if end + size > len(data):
+                    return None
+                parts.append(data[end:end + size])
+                end += size
+
+            return (end, code, timestamp, parts if layout is not None else parts[0])
+
+        # Text data
+        end = data.find('\n', position)
+        if end == -1:
+            return None
+        response = data[position + 1:end + 1].split(',', 1)
+        timestamp = ord(response[0][0])
+        try:
+            response = response[1]
+        except IndexError:
+            response = ''
+        return (end + 1, code, timestamp, response)
+
+    def _save_response(self, code, timestamp, response, size=0):
+        """Find the right request and give it the response."""
+        request = self.pending.pop(code, timestamp)
+        self.rtt.received(request, time.time())
+        if self.stats is not None:
+            self._record_response(request, code, response, size)
+        elif request is not None:
+            request.set_response(response)
+        else:
+            self.logger.debug('No request is waiting for the response.')
+
+    def _record_response(self, request, code, response, size):
+        """Give the request the response and record the statistics."""
+        received_at = time.time()
+        if request is None:
+            self.stats.unexpected_response(size)
+            self.logger.debug('No request is waiting for the response.')
+            return
+
+        self.stats.received(code, size, received_at - request.sent_at)
+        request.set_response(response)
+        self.stats.callback_finished(code, time.time() - received_at)
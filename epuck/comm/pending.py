@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+
+
+class PendingRequests(object):
+    """Requests that were sent to the robot and wait for a response.
+
+    The requests are indexed by the response code and the timestamp, so a
+    response finds its request in constant time no matter in which order the
+    robot answers. The deadlines are kept separately in a heap, the heap
+    entries of requests that got their response are thrown away lazily.
+
+    """
+
+    def __init__(self):
+        # Stored are requests under the key (response code, timestamp).
+        self.requests = {}
+        # Stored are tuples (deadline, sequence number, request).
+        self.deadlines = []
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, request, deadline):
+        """Add the request that should be answered before the deadline.
+
+        Return the request that was waiting with the same response code and
+        timestamp and has been replaced, otherwise None.
+
+        """
+        key = (request.response_code, request.timestamp)
+        replaced = self.requests.get(key)
+        self.requests[key] = request
+        request.deadline = deadline
+        heapq.heappush(self.deadlines, (deadline, self.sequence.next(), request))
+        if replaced is request:
+            return None
+        return replaced
+
+    def get(self, code, timestamp):
+        """Return the request waiting for given response."""
+        return self.requests.get((code, timestamp))
+
+    def pop(self, code, timestamp):
+        """Remove and return the request waiting for given response."""
+        return self.requests.pop((code, timestamp), None)
+
+    def next_deadline(self):
+        """Return the earliest deadline or None if nothing is waiting."""
+        while self.deadlines:
+            deadline, sequence, request = self.deadlines[0]
+            if self._is_waiting(deadline, request):
+                return deadline
+            heapq.heappop(self.deadlines)
+        return None
+
+    def pop_expired(self, now):
+        """Remove and return the requests with deadline before now."""
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, sequence, request = heapq.heappop(self.deadlines)
+            if self._is_waiting(deadline, request):
+                del self.requests[(request.response_code, request.timestamp)]
+                expired.append(request)
+        return expired
+
+    def _is_waiting(self, deadline, request):
+        """Decide whether the heap entry belongs to a waiting request."""
+        key = (request.response_code, request.timestamp)
+        return self.requests.get(key) is request and request.deadline == deadline
+
+
+class ResponseLayouts(object):
+    """Layouts of the binary responses the robot may send.
+
+    A binary response with a fixed layout isn't preceded by its size, so
+    it can be read only if the layout is known, even if its request has
+    already been answered, expired or is sent again. The layout of every
+    request is kept under its response code and timestamp until another
+    request with them is sent. A response with an unknown timestamp is read
+    with the layout of the last single command with the code.
+
+    """
+
+    def __init__(self):
+        # Stored are layouts under the key (response code, timestamp).
+        self.layouts = {}
+        # Stored are layouts of single commands under the response code.
+        self.last = {}
+
+    def add(self, code, timestamp, layout):
+        """Remember the layout of the request being sent."""
+        self.layouts[(code, timestamp)] = layout
+        if layout is None or len(layout) == 1:
+            self.last[code] = layout
+
+    def get(self, code, timestamp):
+        """Return the layout of the response, None if it starts with its size."""
+        try:
+            return self.layouts[(code, timestamp)]
+        except KeyError:
+            return self.last.get(code)
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import array
+import bisect
+import collections
+import mmap
+import struct
+import threading
+import time
+
+from epuck.comm import CommError
+from epuck.comm.stats import code_name
+
+# The log starts with the magic and the version of the format, records
+# follow. Every record is a header (arrival time, response code, timestamp,
+# payload length) followed by the payload.
+MAGIC = 'EPUCKLOG'
+VERSION = 1
+FILE_HEADER = struct.Struct('<8sH')
+RECORD_HEADER = struct.Struct('<dccI')
+
+LogRecord = collections.namedtuple('LogRecord', 'time code timestamp payload')
+
+
+class RecorderError(CommError):
+    """The log file is broken or has an unknown format."""
+    pass
+
+
+def _payload(response):
+    """Return the bytes of the response as it's passed to the callback.
+
+    The parts of a response to a batch of binary commands are concatenated.
+
+    """
+    if isinstance(response, list):
+        return ''.join(_payload(part) for part in response)
+    if isinstance(response, memoryview):
+        return response.tobytes()
+    return str(response)
+
+
+class Recorder(object):
+    """Append every response received from the robot to a binary log.
+
+    Assign the recorder to the comm attribute recorder (or pass the path as
+    the record argument of Controller). The responses are written as they
+    come, with their arrival time, before they are matched with requests,
+    so unexpected responses are recorded as well. The log is read by
+    LogReader.
+
+    """
+
+    def __init__(self, path, buffering=64 * 1024):
+        self.path = path
+        self.file = open(path, 'ab', buffering)
+        self.lock = threading.Lock()
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.records = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, code, timestamp, response, arrival=None):
+        """Append the response to the log."""
+        payload = _payload(response)
+        with self.lock:
+            # The time is taken under the lock, so the records are in order.
+            if arrival is None:
+                arrival = time.time()
+            header = RECORD_HEADER.pack(arrival, code, chr(timestamp), len(payload))
+            self.file.write(header)
+            self.file.write(payload)
+            self.records += 1
+
+    def flush(self):
+        """Write the buffered records to the file."""
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        """Write the buffered records and close the file."""
+        with self.lock:
+            self.file.close()
+
+
+class LogReader(object):
+    """Read the log written by Recorder without loading the whole file.
+
+    The file is memory-mapped and only the headers of the records are read
+    when the log is opened, to build the index of record offsets. Payloads
+    are copied from the map only for the records that are returned.
+
+    Usage:
+        with LogReader('session.log') as log:
+            for record in log.select(code='d', start=t0, end=t0 + 10):
+                print record.time, record.payload
+
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file can't be mapped.
+            self.file.close()
+            raise RecorderError("The log %s is empty." % path)
+
+        if len(self.map) < FILE_HEADER.size \
+        or FILE_HEADER.unpack_from(self.map, 0) != (MAGIC, VERSION):
+            self.close()
+            raise RecorderError("The file %s is not a log of version %d."
+                                % (path, VERSION))
+
+        # Offsets, arrival times and codes of the records in file order.
+        self.offsets = array.array('L')
+        self.times = array.array('d')
+        self.codes = []
+        self._index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return self._read(self.offsets[i])
+
+    def __iter__(self):
+        for offset in self.offsets:
+            yield self._read(offset)
+
+    def close(self):
+        """Unmap and close the log."""
+        self.map.close()
+        self.file.close()
+
+    def select(self, code=None, start=None, end=None):
+        """Yield the records with given response code arrived in [start, end).
+
+        The responses arrive in time order, so the time range is found by
+        binary search, only the records in the range are checked for code.
+        Binary codes can be given by the command as well, e.g. '-E'.
+
+        """
+        if code is not None and len(code) == 2 and code[0] == '-':
+            code = chr(256 - ord(code[1]))
+        first = bisect.bisect_left(self.times, start) if start is not None else 0
+        last = bisect.bisect_left(self.times, end) if end is not None else len(self)
+        for i in xrange(first, last):
+            if code is None or self.codes[i] == code:
+                yield self._read(self.offsets[i])
+
+    def count(self):
+        """Return a dictionary with the numbers of records of each code.
+
+        Binary codes are named by the command, e.g. '-E'.
+
+        """
+        counts = collections.defaultdict(int)
+        for code in self.codes:
+            counts[code_name(code)] += 1
+        return dict(counts)
+
+    def _index(self):
+        """Read the headers of all records."""
+        offset = FILE_HEADER.size
+        size = len(self.map)
+        while offset + RECORD_HEADER.size <= size:
+            arrival, code, timestamp, length = RECORD_HEADER.unpack_from(self.map, offset)
+            if offset + RECORD_HEADER.size + length > size:
+                # The last record hasn't been written whole.
+                break
+            self.offsets.append(offset)
+            self.times.append(arrival)
+            self.codes.append(code)
+            offset += RECORD_HEADER.size + length
+
+    def _read(self, offset):
+        """Return the record starting at the offset."""
+        arrival, code, timestamp, length = RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + RECORD_HEADER.size
+        return LogRecord(arrival, code, ord(timestamp), self.map[start:start + length])
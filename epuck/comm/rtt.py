@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+class RoundTripEstimator(object):
+    """Smoothed round trip time of one kind of requests (see RFC 6298)."""
+
+    ALPHA = 1 / 8.
+    BETA = 1 / 4.
+    K = 4
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+
+    def measured(self, rtt):
+        """Update the estimate with new sample."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+    def timeout(self):
+        """Return the retransmission timeout, None if nothing was measured."""
+        if self.srtt is None:
+            return None
+        return self.srtt + self.K * self.rttvar
+
+
+class RetransmissionTimer(object):
+    """Decide how long to wait for responses before sending a command again.
+
+    The round trip time is measured for every response code separately, a
+    photo takes much longer than setting a LED. Binary responses of the
+    same code can have various layouts (e.g. batches of different commands),
+    so they are estimated separately as well. Until the first response of
+    a kind arrives, the initial timeout is used.
+
+    The robot handles the commands one by one, a pipelined request waits
+    behind the requests sent before it. So the round trip and the deadline
+    are counted from when the request got to the head of the line: the
+    later of its sending and the arrival of the previous response.
+
+    Only the requests answered on the first try are measured, it's not known
+    which try a response to a repeated request belongs to (Karn's rule).
+    The estimated timeout is never shorter than min_timeout (1 s like in
+    RFC 6298), a steady link would otherwise shrink it to the round trip
+    itself. Every repetition doubles the timeout up to max_timeout (twice
+    the initial timeout by default), unless the timeout is longer already.
+
+    """
+
+    def __init__(self, initial=0.5, min_timeout=1.0, max_timeout=None):
+        self.initial = initial
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout if max_timeout is not None else 2 * initial
+        # Stored are RoundTripEstimators under the keys of requests.
+        self.estimators = {}
+        # When the last response arrived, None before the first one.
+        self.last_received = None
+
+    def _key(self, request):
+        layout = request.response_layout
+        if layout is not None:
+            layout = tuple(layout)
+        return request.response_code, layout
+
+    def timeout(self, request):
+        """Return how long to wait for the response to the request."""
+        estimator = self.estimators.get(self._key(request))
+        timeout = estimator.timeout() if estimator is not None else None
+        if timeout is None:
+            timeout = self.initial
+        else:
+            timeout = max(self.min_timeout, timeout)
+        return min(max(self.max_timeout, timeout), timeout * 2 ** request.tries)
+
+    def started(self, request):
+        """Return when the request got to the head of the line."""
+        if self.last_received is None:
+            return request.written_at
+        return max(request.written_at, self.last_received)
+
+    def deadline(self, request):
+        """Return when the request should be sent again."""
+        return self.started(request) + self.timeout(request)
+
+    def received(self, request, received_at):
+        """Note the arrival of the response to the request.
+
+        The round trip time of the request is used for the estimate. The
+        request is None if no request waited for the response.
+
+        """
+        if request is not None and request.tries == 0:
+            key = self._key(request)
+            estimator = self.estimators.get(key)
+            if estimator is None:
+                estimator = self.estimators[key] = RoundTripEstimator()
+            estimator.measured(received_at - self.started(request))
+        self.last_received = received_at
+
+    def reset(self):
+        """Forget all measurements."""
+        self.estimators = {}
+        self.last_received = None
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import bisect
+
+
+def code_name(code):
+    """Return readable name of the response code.
+
+    Text responses are named by their code (e.g. 'e'), binary responses by
+    the command (e.g. '-E').
+
+    """
+    if ord(code) >= 127:
+        return '-' + chr(256 - ord(code))
+    return code
+
+
+def binary_size(response, layout=None):
+    """Return the number of bytes of the binary response with its headers."""
+    if layout is None:
+        response, layout = [response], [None]
+    return 2 + sum(len(part) + (2 if size is None else 0)
+                   for part, size in zip(response, layout))
+
+
+class CodeStats(object):
+    """Counters of the commands with one response code."""
+
+    def __init__(self, buckets):
+        self.sent = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.superseded = 0
+        self.received = 0
+        self.latency_sum = 0.
+        self.latency_max = 0.
+        self.callback_time = 0.
+        # The last bucket counts latencies over the last bound.
+        self.histogram = (len(buckets) + 1) * [0]
+
+    def snapshot(self, buckets):
+        """Return the counters as a dictionary."""
+        latency = {
+            'mean': self.latency_sum / sum(self.histogram) if any(self.histogram) else None,
+            'max': self.latency_max,
+            'histogram': list(self.histogram),
+        }
+        for p in (50, 90, 99):
+            latency['p%d' % p] = self._percentile(p, buckets)
+        return {
+            'sent': self.sent,
+            'retries': self.retries,
+            'timeouts': self.timeouts,
+            'failures': self.failures,
+            'superseded': self.superseded,
+            'received': self.received,
+            'latency': latency,
+            'callback_time': self.callback_time,
+        }
+
+    def _percentile(self, p, buckets):
+        """Return the upper bound of the bucket with the percentile."""
+        count = sum(self.histogram)
+        if not count:
+            return None
+        limit = p / 100. * count
+        total = 0
+        for i, n in enumerate(self.histogram):
+            total += n
+            if total >= limit:
+                return buckets[i] if i < len(buckets) else self.latency_max
+
+
+class CommStats(object):
+    """Statistics of the communication with the robot.
+
+    The communication classes call the methods below when they send
+    commands, receive responses, run callbacks and retry commands. When the
+    statistics are disabled, the stats attribute of the communication is
+    None and nothing is recorded.
+
+    The latencies are measured from the first time the command is sent to
+    the arrival of its response and are counted in a histogram with
+    buckets given by their upper bounds in seconds.
+
+    """
+
+    BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5.]
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets if buckets is not None else self.BUCKETS
+        self.reset()
+
+    def reset(self):
+        """Set all counters to zero."""
+        # Stored are CodeStats under the response codes.
+        self.codes = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.unexpected = 0
+        self.unknown = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.pending = 0
+        self.max_pending = 0
+
+    def _code(self, code):
+        """Return the counters of the response code."""
+        stats = self.codes.get(code)
+        if stats is None:
+            stats = self.codes[code] = CodeStats(self.buckets)
+        return stats
+
+    def sent(self, code, size, retry=False):
+        """Count the command written to the robot."""
+        stats = self._code(code)
+        stats.sent += 1
+        if retry:
+            stats.retries += 1
+        self.bytes_out += size
+
+    def received(self, code, size, latency=None):
+        """Count the response to a request, the latency may be unknown."""
+        self.bytes_in += size
+        stats = self._code(code)
+        stats.received += 1
+        if latency is None:
+            return
+        stats.latency_sum += latency
+        if latency > stats.latency_max:
+            stats.latency_max = latency
+        stats.histogram[bisect.bisect_left(self.buckets, latency)] += 1
+
+    def unexpected_response(self, size):
+        """Count the response no request is waiting for."""
+        self.bytes_in += size
+        self.unexpected += 1
+
+    def unknown_command(self, size):
+        """Count the 'z' response to a command the robot doesn't know."""
+        self.bytes_in += size
+        self.unknown += 1
+
+    def callback_finished(self, code, duration):
+        """Count the time spent in the callback processing the response."""
+        self._code(code).callback_time += duration
+
+    def timed_out(self, code):
+        """Count the command that wasn't answered in time."""
+        self._code(code).timeouts += 1
+
+    def failed(self, code):
+        """Count the command given up after too many tries."""
+        self._code(code).failures += 1
+
+    def superseded(self, code):
+        """Count the command replaced by a newer one before it was sent."""
+        self._code(code).superseded += 1
+
+    def queued(self, queue_depth, pending):
+        """Record the number of requests waiting to be sent and answered."""
+        self.queue_depth = queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        self.pending = pending
+        self.max_pending = max(self.max_pending, pending)
+
+    def snapshot(self):
+        """Return all statistics as a dictionary."""
+        codes = dict(self.codes)
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'unexpected': self.unexpected,
+            'unknown': self.unknown,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'buckets': list(self.buckets),
+            'codes': dict((code_name(code), stats.snapshot(self.buckets))
+                          for code, stats in codes.items()),
+        }
@@ -3,8 +3,13 @@
 
 import logging
 import serial
+import time
 
 from epuck.comm import CommError
+from epuck.comm.buffers import BufferPool, detach
+from epuck.comm.pending import ResponseLayouts
+from epuck.comm.stats import binary_size
+from epuck.comm.window import InFlightWindow
 
 
 class SyncCommError(CommError):
@@ -29,38 +34,105 @@ class SyncComm(object):
         except serial.SerialException as e:
             raise SyncCommError(e.message)
 
+        # Binary responses are read into buffers from the pool.
+        self.buffer_pool = BufferPool()
+        self.borrowed_buffers = []
+        self.size_buffer = bytearray(2)
+
+        # CommStats recording the communication, None when disabled.
+        self.stats = None
+        self.sent_at = None
+        # Recorder logging all responses, None when disabled.
+        self.recorder = None
+
+        # Commands are sent one by one, but a callback can send another
+        # command before the timestamp of its command is given back.
+        self.window = InFlightWindow(len(InFlightWindow.TIMESTAMPS) - 2)
+        # Late responses of earlier commands are read with their layouts.
+        self.layouts = ResponseLayouts()
+
         self.logger = logging.getLogger('SyncComm')
 
-    def send_command(self, command, timestamp, command_code, callback=lambda x:x):
+    def send_command(self, command, timestamp, command_code, callback=lambda x:x,
+                     response_layout=None, coalesce_key=None):
         """Send new command and return the response.
 
         Will block the execution until the robot returns something or timeout
         occurs.
 
+        The response_layout describes the parts of a binary response, see
+        _read_binary_data. The commands are never deferred, so the
+        coalesce_key is not used.
+
         """
-        self.logger.debug('Sending new command. Command: "%s", code: "%s", timestamp: "%s".' % (command, command_code, timestamp))
+        self.logger.debug('Sending new command. Command: "%s", code: "%s", timestamp: "%s".', command, command_code, timestamp)
 
+        self.layouts.add(command_code, timestamp, response_layout)
         self.serial_connection.write(command)
+        if self.stats is not None:
+            self.sent_at = time.time()
+            self.stats.sent(command_code, len(command))
+            self.stats.queued(0, 1)
 
-        response = None
-        while response is None:
-            response = self._read_response(timestamp, command_code)
-
+        try:
+            response = None
+            try:
+                while response is None:
+                    response = self._read_response(timestamp, command_code)
+            except SyncCommError:
+                if self.stats is not None:
+                    self.stats.timed_out(command_code)
+                    self.stats.failed(command_code)
+                raise
+
+            if self.stats is None:
+                return detach(callback(response))
+
+            received_at = time.time()
+            try:
+                return detach(callback(response))
+            finally:
+                self.stats.callback_finished(command_code, time.time() - received_at)
+        finally:
+            self._release_buffers()
+
+    def resolved(self, response, callback=lambda x: x):
+        """Return the result of a command answered without the robot."""
         return callback(response)
 
+    def allocate_timestamp(self, blocking=True):
+        """Return a timestamp for a new command.
+
+        Never block, nobody else could give a timestamp back. Raise
+        SyncCommError if the commands are nested too deep.
+
+        """
+        timestamp = self.window.acquire(False)
+        if timestamp is None:
+            raise SyncCommError("Too many commands sent from callbacks.")
+        return timestamp
+
+    def release_timestamp(self, timestamp):
+        """Give back the timestamp once the command is done."""
+        self.window.release(timestamp)
+
     def _read_response(self, timestamp, command_code):
-        """Read a response."""
+        """Read a response, None if it isn't the response of the command."""
         code = self.serial_connection.read(1)
 
         try:
             # Binary data
             if ord(code) >= 127:
                 ts = ord(self.serial_connection.read(1))
-                response = self._read_binary_data()
+                layout = self.layouts.get(code, ts)
+                response = self._read_binary_data(layout)
+                size = binary_size(response, layout)
             # Text data
             else:
                 ts = ord(self.serial_connection.read(1))
-                response = self._read_text_data().split(",", 1)
+                data = self._read_text_data()
+                size = 2 + len(data)
+                response = data.split(",", 1)
                 try:
                     response = response[1]
                 except IndexError:
@@ -68,24 +140,71 @@ class SyncComm(object):
         except TypeError:
             raise SyncCommError("No response received")
 
-        self.logger.debug('Received response. Code: "%s", timestamp: "%s", response: "%s".' % (code, ts, response))
+        self.logger.debug('Received response. Code: "%s", timestamp: "%s", response: "%s".', code, ts, response)
+        if self.recorder is not None:
+            self.recorder.record(code, ts, response)
 
         if ts == timestamp and command_code == code:
+            if self.stats is not None:
+                self.stats.received(code, size, time.time() - self.sent_at)
             return response
         else:
+            if self.stats is not None:
+                if code == 'z':
+                    self.stats.unknown_command(size)
+                else:
+                    self.stats.unexpected_response(size)
             return None
 
-    def _read_binary_data(self):
+    def _read_binary_data(self, layout=None):
         """Read binary data from the robot.
 
         Some responses are binary. The robot first sends 2 bytes containing the
         size of the data. The data then follows.
 
+        The answer to several binary commands sent in one packet is made of
+        several parts. The layout is then a list of their sizes, None stands
+        for a part that starts with its own size. A list of the parts is
+        returned.
+
         """
-        lo, hi = self.serial_connection.read(2)
-        size = (ord(hi) << 8) + ord(lo)
-        data = self.serial_connection.read(size)
-        return data
+        if layout is None:
+            return self._read_binary_part(None)
+        return [self._read_binary_part(size) for size in layout]
+
+    def _read_binary_part(self, size):
+        """Read one part of binary data, possibly preceded by its size.
+
+        The data are read into a buffer borrowed from the pool and a
+        memoryview of them is returned. The buffers are given back by
+        _release_buffers once the response has been processed.
+
+        """
+        if size is None:
+            self._read_into(memoryview(self.size_buffer))
+            size = self.size_buffer[0] + (self.size_buffer[1] << 8)
+
+        buffer = self.buffer_pool.acquire(size)
+        self.borrowed_buffers.append(buffer)
+        return self._read_into(memoryview(buffer)[:size])
+
+    def _read_into(self, view):
+        """Fill the view with data from the robot and return it.
+
+        Raise SyncCommError if it hasn't been filled before timeout.
+
+        """
+        received = self.serial_connection.readinto(view)
+        if received != len(view):
+            raise SyncCommError("Response has been cut off, received %d of %d bytes."
+                     % (received, len(view)))
+        return view
+
+    def _release_buffers(self):
+        """Return the borrowed buffers to the pool."""
+        for buffer in self.borrowed_buffers:
+            self.buffer_pool.release(buffer)
+        self.borrowed_buffers = []
 
     def _read_text_data(self):
         """Read a text response from the robot.
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import string
+import threading
+
+
+class InFlightWindow(object):
+    """Limit the number of commands waiting for a response.
+
+    Every command sent to the robot gets a timestamp, which identifies its
+    response. The window hands out the timestamps and takes them back once
+    the command is answered or fails, so a timestamp is never used by two
+    commands waiting at the same time. No more than size commands can wait
+    at once, acquire blocks until some of them is done.
+
+    The timestamps are reused in the order they were returned, so the
+    robot, which ignores a command with the same timestamp as the previous
+    one, never gets two consecutive commands with the same timestamp.
+
+    """
+
+    # Timestamps must not be '\n' or '\r' which end a text command, nor ','
+    # which separates the data of a text response.
+    TIMESTAMPS = string.ascii_letters + string.digits
+
+    def __init__(self, size=16):
+        if not 0 < size <= len(self.TIMESTAMPS) - 2:
+            raise ValueError("Window size must be between 1 and %d."
+                             % (len(self.TIMESTAMPS) - 2))
+        self.size = size
+        self.free = collections.deque(ord(c) for c in self.TIMESTAMPS)
+        self.outstanding = set()
+        self.last = None
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def full(self):
+        """Return whether no more commands can be sent."""
+        return len(self.outstanding) >= self.size
+
+    def acquire(self, blocking=True, ready=None):
+        """Return a timestamp for a new command.
+
+        Wait while the window is full, or while ready() returns False if
+        given (see changed). If blocking is False, return None instead of
+        waiting.
+
+        """
+        self.condition.acquire()
+        try:
+            while self.full() or (ready is not None and not ready()):
+                if not blocking:
+                    return None
+                self.condition.wait()
+
+            timestamp = self.free.popleft()
+            if timestamp == self.last:
+                self.free.append(timestamp)
+                timestamp = self.free.popleft()
+            self.outstanding.add(timestamp)
+            self.last = timestamp
+            return timestamp
+        finally:
+            self.condition.release()
+
+    def changed(self):
+        """Wake up the callers waiting in acquire to check ready() again."""
+        self.condition.acquire()
+        try:
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def release(self, timestamp):
+        """Take back the timestamp of a command that is done."""
+        self.condition.acquire()
+        try:
+            if timestamp in self.outstanding:
+                self.outstanding.remove(timestamp)
+                self.free.append(timestamp)
+                self.condition.notify()
+        finally:
+            self.condition.release()
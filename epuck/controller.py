@@ -1,18 +1,27 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import decorator
+import collections
+import functools
 import logging
-import random
-import string
 import struct
-import Image
+import time
 
-from comm.async import AsyncComm
-from comm.sync import SyncComm
+import audio
+import imaging
 from comm import CommError
+from comm.coalesce import UNASSIGNED
+from comm.buffers import detach
+from comm.recorder import Recorder
+from comm.stats import CommStats
+from cache import StateCache
+from records import SensorValues, Acceleration, Volume
 from epuck import EPuckError
 
+# Modes of the camera.
+GREYSCALE_MODE = 0
+RGB565_MODE = 1
+
 
 class ControllerError(EPuckError):
     """E-Puck robot is not responding as it should."""
@@ -23,16 +32,369 @@ class WrongCommand(ControllerError):
     pass
 
 
-def command(func):
-    """Decorator for commands in controller."""
-    def _command(func, self, *args, **kwargs):
-        self.command_index = (self.command_index + 1) % len(string.ascii_letters)
-        self.command_i = ord(string.ascii_letters[self.command_index])
+def _identity(value):
+    return value
+
+
+def _decode_error(e):
+    """Log the error of decoding a response, return ControllerError."""
+    logging.getLogger('Controller').error(e)
+    return ControllerError(e)
+
+
+class ProtocolCommand(object):
+    """Command of the robot with its encoder and decoder.
+
+    A text command is sent as the code, the timestamp and the arguments as
+    decimal numbers separated by commas, the robot answers with the lower
+    case code and the values separated by commas. A binary command is sent
+    as the negated code, the timestamp, the argument bytes and zero, the
+    robot answers with the same code and the data. The size of the data
+    precedes them unless the layout of the response is fixed.
+
+    The encoder and the decoders are built when the command is created, so
+    sending the command only fills in the values.
+
+    Atributes:
+        name -- Name of the Controller method sending the command.
+        code -- The character of the command.
+        arguments -- Formats of the arguments, 'd' for a number of a text
+            command or struct format characters of a binary command.
+        binary -- Whether the command is binary.
+        layout -- Struct format of the binary response.
+        sized -- Whether the binary response is preceded by its size.
+        convert -- Function creating the result from the decoded values. The
+            values of a text response are decoded only if it's given.
+        decoder -- Function decoding the data instead of the layout.
+        doc -- Documentation of the method generated for the command.
+
+    """
+
+    def __init__(self, name, code, arguments='', binary=False, layout=None,
+                 sized=False, convert=None, decoder=None, doc=None):
+        self.name = name
+        self.code = code
+        self.binary = binary
+        self.doc = doc
+
+        if binary:
+            self.command_code = self.response_code = chr(256 - ord(code))
+            self.pack_arguments = struct.Struct('<' + arguments).pack
+            self.encode = self._binary_encoder(arguments)
+        else:
+            self.command_code = code
+            self.response_code = code.lower()
+            self.encode = self._text_encoder(arguments)
+
+        self.decode = self._decoder(layout, convert, decoder)
+        # Size of the response, if it isn't preceded by it.
+        self.size = struct.calcsize(layout) if binary and not sized else None
+        # Layout of the response passed to the comm and the decoder of the
+        # response as the comm passes it to the callback.
+        if self.size is not None:
+            self.response_layout = [self.size]
+            decode = self.decode
+            self.decode_response = lambda response: decode(response[0])
+        else:
+            self.response_layout = None
+            self.decode_response = self.decode
+
+    def _binary_encoder(self, arguments):
+        """Return the function encoding the binary command.
+
+        The function is given a tuple of the timestamp and the arguments.
+
+        """
+        if not arguments.strip('cB'):
+            # All arguments are single bytes, the command can be formatted.
+            return (self.command_code + '%c' * (len(arguments) + 1) + '\x00').__mod__
+
+        pack = struct.Struct('<B%sx' % arguments).pack
+        command_code = self.command_code
+        def _encode(values):
+            return command_code + pack(*values)
+        return _encode
+
+    def _text_encoder(self, arguments):
+        """Return the function encoding the text command.
+
+        The function is given a tuple of the timestamp and the arguments.
+
+        """
+        return (self.code + '%c' + ''.join(',%' + f for f in arguments) + '\n').__mod__
+
+    def _decoder(self, layout, convert, decoder):
+        """Return the function decoding the data of the response or None."""
+        if decoder is not None:
+            return decoder
+
+        if layout is not None:
+            unpack_from = struct.Struct(layout).unpack_from
+            convert = convert or _identity
+            def _decode_binary(data):
+                try:
+                    values = unpack_from(data)
+                except struct.error as e:
+                    raise _decode_error(e)
+                return convert(values)
+            return _decode_binary
+
+        if convert is not None:
+            def _decode_text(data):
+                try:
+                    values = [int(value) for value in data.strip().split(',')]
+                except ValueError as e:
+                    raise _decode_error(e)
+                return convert(values)
+            return _decode_text
+
+        # The response only confirms the command.
+        return None
+
+
+def _first(values):
+    return values[0]
+
+
+def _camera(values):
+    return dict(zip(['mode', 'width', 'height', 'zoom'], values))
+
+
+def _spherical_acceleration(values):
+    acceleration, orientation, inclination = values
+    return {'acceleration': acceleration, 'orientation': orientation,
+            'inclination': inclination}
+
+
+def _decode_photo(response):
+    """Create an image from the binary response to get_photo.
+
+    The response can be a string or a memoryview of a pooled buffer.
+
+    """
+    # PIL is imported by the first photo, the controller works without it.
+    import Image
+
+    mode = ord(response[0])
+    width = ord(response[1]) + (ord(response[2]) << 8);
+    height = ord(response[3]) + (ord(response[4]) << 8);
+    image = response[5:]
+
+    if mode == RGB565_MODE:
+        ret = imaging.rgb565_to_rgb(image)
+        return Image.fromstring('RGB', (width, height), ret).rotate(90)
+
+    elif mode == GREYSCALE_MODE:
+        return Image.fromstring('L', (width, height), detach(image)).rotate(90)
+
+
+def _decode_microphone(response):
+    """Decode the binary response to get_microphone."""
+    # The robot sends the parts of the complex numbers as signed chars.
+    data = struct.unpack_from('%db' % len(response), response)
+    return [x + y * 1j for x,y in zip(data[::2], data[1::2])]
+
+
+# Commands of the robot under the names of the Controller methods sending
+# them. A command added here gets a Controller method (and a BinaryBatch
+# method if it's binary) unless the classes define one.
+COMMANDS = dict((command.name, command) for command in [
+    ProtocolCommand('set_speed', 'D', 'dd'),
+    ProtocolCommand('get_speed', 'E', binary=True, layout='<hh'),
+    ProtocolCommand('set_body_led', 'B', 'd'),
+    ProtocolCommand('set_front_led', 'F', 'd'),
+    ProtocolCommand('set_led', 'L', 'dd'),
+    # The shipped firmware answers the selector only with text.
+    ProtocolCommand('get_turning_selector', 'C', convert=_first),
+    ProtocolCommand('get_proximity_sensors', 'N', binary=True, layout='<8h',
+                    convert=SensorValues),
+    ProtocolCommand('get_ambient_sensors', 'O', binary=True, layout='<8h',
+                    convert=SensorValues),
+    ProtocolCommand('get_floor_sensors', 'M', binary=True, layout='>3H',
+                    doc="Read the 3 floor sensors (an optional extension)."),
+    ProtocolCommand('set_camera', 'J', 'dddd'),
+    ProtocolCommand('get_camera', 'I', convert=_camera),
+    ProtocolCommand('get_photo', 'I', binary=True, sized=True,
+                    decoder=_decode_photo),
+    ProtocolCommand('reset', 'R'),
+    ProtocolCommand('set_motor_pos', 'P', 'dd'),
+    ProtocolCommand('get_motor_pos', 'Q', binary=True, layout='<hh',
+                    convert=list),
+    ProtocolCommand('get_raw_accelerometer', 'a', binary=True, layout='<3h',
+                    convert=Acceleration),
+    ProtocolCommand('get_accelerometer', 'A', binary=True, layout='<fff',
+                    sized=True, convert=_spherical_acceleration),
+    ProtocolCommand('calibrate_sensors', 'K'),
+    ProtocolCommand('stop', 'S'),
+    ProtocolCommand('play_sound', 'T', 'd'),
+    ProtocolCommand('get_volume', 'u', binary=True, layout='<3h',
+                    convert=Volume),
+    ProtocolCommand('get_microphone', 'Z', 'c', binary=True, sized=True,
+                    decoder=_decode_microphone),
+])
+
+
+def _timestamped(func, blocking):
+    """Return the method calling the command with a new timestamp.
+
+    The timestamp is in self.command_i while the command is sent.
+
+    """
+    @functools.wraps(func)
+    def _call_command(self, *args, **kwargs):
+        timestamp = self.comm.allocate_timestamp(blocking)
+        self.command_i = timestamp if timestamp is not None else UNASSIGNED
+        ret = None
         try:
-            return func(self, *args, **kwargs)
+            ret = func(self, *args, **kwargs)
         except CommError as e:
             self.logger.error(e)
-    return decorator.decorator(_command, func)
+        finally:
+            # Handlers give the timestamp back once they are done.
+            if timestamp is not None and not hasattr(ret, 'done'):
+                self.comm.release_timestamp(timestamp)
+        return ret
+    return _call_command
+
+
+def command(func):
+    """Decorator for commands in controller."""
+    return _timestamped(func, True)
+
+
+def cached(key):
+    """Decorator for commands reading the state kept in the StateCache.
+
+    If the controller has the cache and the value is fresh, the command
+    isn't sent and the cached value is returned (as a finished handler in
+    async). Otherwise the value read from the robot is stored.
+
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _cached(self, callback=_identity):
+            if self.cache is None:
+                return func(self, callback=callback)
+
+            value = self.cache.get(key)
+            if value is not None:
+                return self.comm.resolved(value, callback)
+
+            generation = self.cache.generation(key)
+            def _store(value):
+                self.cache.put(key, value, generation)
+                return callback(value)
+            return func(self, callback=_store)
+        return _cached
+    return _decorator
+
+
+def actuator(func):
+    """Decorator for commands setting the state of the robot.
+
+    If too many commands wait for a response, the command doesn't block.
+    It is deferred until some of them is answered and a newer command with
+    the same coalesce key replaces it, see comm.coalesce.DeferredRequests.
+
+    """
+    return _timestamped(func, False)
+
+
+def _streamed(ret):
+    """Return the result of a command sent by a stream.
+
+    A failed command returns None (the error is logged), the stream can't
+    continue without its result, so CommError is raised instead.
+
+    """
+    if ret is None:
+        raise CommError("The command of the stream has failed.")
+    return ret
+
+
+class BinaryBatch(object):
+    """Several binary commands sent to the robot in one packet.
+
+    The robot answers all commands of the packet with one response, which
+    saves a round trip for every command but the first one. The batch is
+    usually used as a context manager, the packet is sent when the block
+    ends::
+
+        with controller.batch() as batch:
+            batch.get_speed()
+            batch.get_photo()
+        speed, photo = batch.result
+
+    The result is a list of responses in the order of the commands, for the
+    asynchronous communication it is a RequestHandler returning the list.
+
+    The batch has a method for every binary command in COMMANDS.
+
+    Note: The whole response must fit into the robot's buffer, which is
+    sized for a 40x40 color photo and few more bytes.
+
+    Note: A packet with several commands needs the firmware rebuilt from
+    firmware/BTcomDM.c. The shipped BTcomDM.hex hangs on the second command
+    of the packet.
+
+    """
+
+    def __init__(self, controller, callback=_identity):
+        self.controller = controller
+        self.callback = callback
+        # Stored are tuples (command, arguments, part size, parser).
+        self.commands = []
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.commands:
+            self.send()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def _add(self, name, args=()):
+        """Add the binary command from COMMANDS to the packet."""
+        command = COMMANDS[name]
+        self.commands.append((command.command_code, command.pack_arguments(*args),
+                              command.size, command.decode))
+        return self
+
+    def get_microphone(self, on):
+        """Add the command returning FFT of data from microphones."""
+        return self._add('get_microphone', ('1' if on else '0',))
+
+    def send(self):
+        """Send the packet and return the result."""
+        self.result = self.controller._send_batch(self)
+        return self.result
+
+    def parse(self, parts):
+        """Split the response to the responses of the commands."""
+        responses = [parser(part) for (command, args, size, parser), part
+                     in zip(self.commands, parts)]
+        return self.callback(responses)
+
+
+class Frame(object):
+    """Photo returned by Controller.stream_photos.
+
+    Atributes:
+        image -- The photo.
+        sent_at -- When the command taking the photo was sent.
+        received_at -- When the photo was received. The photo was captured
+                       between these two times.
+
+    """
+
+    def __init__(self, image, sent_at, received_at):
+        self.image = image
+        self.sent_at = sent_at
+        self.received_at = received_at
+
 
 class Controller(object):
     """Control E-Puck robot.
@@ -48,10 +410,11 @@ class Controller(object):
 
     MAX_SPEED = 1000
 
-    GREYSCALE_MODE = 0
-    RGB565_MODE = 1
+    GREYSCALE_MODE = GREYSCALE_MODE
+    RGB565_MODE = RGB565_MODE
 
-    def __init__(self, port, asynchronous=False, timeout=0.5, max_tries=10):
+    def __init__(self, port, asynchronous=False, timeout=0.5, max_tries=10,
+                 loop=None, stats=False, window=16, record=None, cache_ttl=None):
         """Create new controller.
 
         Arguments:
@@ -60,20 +423,47 @@ class Controller(object):
                 Synchronous communication is default.
             timeout -- How long to wait before the message is sent again.
             max_tries -- How many tries before raising an exception (in async).
+            loop -- EventLoop driving the communication. The commands then
+                return handlers which can be yielded from tasks of the loop.
+            stats -- Set True to record statistics of the communication,
+                see Controller.stats.
+            window -- How many commands can wait for a response at once (in
+                async), further commands wait until some of them is done.
+            record -- Path of a binary log where all responses are recorded,
+                see comm.recorder.LogReader.
+            cache_ttl -- How many seconds the speed, the selector and the
+                camera settings are served from the cache instead of asking
+                the robot. The cache is disabled by default.
 
         """
 
+        # Only the backend in use is imported.
         try:
-            if asynchronous:
-                self.comm = AsyncComm(port, timeout, max_tries)
+            if loop is not None:
+                from comm.loop import LoopComm
+                self.comm = LoopComm(port, loop, timeout, max_tries, window)
+            elif asynchronous:
+                from comm.async import AsyncComm
+                self.comm = AsyncComm(port, timeout, max_tries, window)
                 self.comm.start()
             else:
+                from comm.sync import SyncComm
                 self.comm = SyncComm(port, timeout)
         except CommError as e:
             raise ControllerError(e)
 
-        self.command_index = random.randrange(len(string.printable))
-        self.command_i = string.printable[self.command_index]
+        self.port = port
+
+        if stats:
+            self.comm.stats = CommStats()
+        if record is not None:
+            self.comm.recorder = Recorder(record)
+
+        # StateCache with state of the robot, None when disabled.
+        self.cache = StateCache(cache_ttl) if cache_ttl is not None else None
+
+        # Timestamp of the command being sent.
+        self.command_i = None
 
         self.motor_speed = [0, 0]
         self.body_led = False
@@ -83,24 +473,123 @@ class Controller(object):
         self.logger = logging.getLogger('Controller')
 
 
-    def _binary_command(self, char):
-        """Translate char to -char."""
-        return chr(256 - ord(char))
+    def stats(self):
+        """Return statistics of the communication.
+
+        The statistics are a dictionary with bytes sent and received,
+        responses nobody waited for ('unexpected') and answers to unknown
+        commands ('unknown'), the number of requests waiting to be sent
+        ('queue_depth') and to be answered ('pending') with their maximums,
+        and counters for each response code under 'codes'. Binary responses
+        are named by the command, e.g. '-E'. The counters of a code are:
+        commands sent, retries, timeouts, failures, responses received,
+        time spent in the callbacks and the latency (mean, max, percentiles
+        and a histogram with buckets given by 'buckets').
+
+        Return None if the statistics are disabled.
+
+        """
+        if self.comm.stats is None:
+            return None
+        return self.comm.stats.snapshot()
+
+    def reset_stats(self):
+        """Set the statistics of the communication to zero."""
+        if self.comm.stats is not None:
+            self.comm.stats.reset()
+
+    def stop_recording(self):
+        """Stop recording the responses and close the log."""
+        if self.comm.recorder is not None:
+            recorder, self.comm.recorder = self.comm.recorder, None
+            recorder.close()
+
+    def _send(self, name, args=(), callback=_identity, decoder=None,
+              coalesce_key=None):
+        """Send the command from COMMANDS with the timestamp self.command_i.
+
+        The response is decoded by the decoder of the command, or by the
+        given one, and passed to the callback.
+
+        """
+        command = COMMANDS[name]
+        decode = decoder or command.decode_response
+        if decode is None:
+            handler = callback
+        elif callback is _identity:
+            handler = decode
+        else:
+            def handler(response):
+                return callback(decode(response))
+
+        timestamp = self.command_i
+        return self.comm.send_command(command.encode((timestamp,) + args),
+                                      timestamp, command.response_code,
+                                      handler, command.response_layout,
+                                      coalesce_key)
+
+    def _write_through(self, key, value, callback):
+        """Return the callback storing the value once the robot sets it.
+
+        The cached value is invalidated right away, the command can fail or
+        be superseded.
+
+        """
+        if self.cache is None:
+            return callback
+        self.cache.invalidate(key)
+        generation = self.cache.generation(key)
+        def _store(response):
+            self.cache.put(key, value, generation)
+            return callback(response)
+        return _store
 
 
+    def batch(self, callback=_identity):
+        """Create a batch of binary commands sent in one packet.
+
+        See BinaryBatch for the supported commands. The robot must run the
+        firmware rebuilt from firmware/BTcomDM.c, not the shipped hex.
+
+        """
+        return BinaryBatch(self, callback)
+
     @command
-    def set_speed(self, left, right, callback=lambda x: x):
+    def _send_batch(self, batch):
+        """Send the commands from the batch in one packet."""
+        if not batch.commands:
+            raise WrongCommand("The batch is empty.")
+
+        first = batch.commands[0][0]
+        packet = [first, chr(self.command_i), batch.commands[0][1]]
+        for command, args, size, parser in batch.commands[1:]:
+            packet.append(command + args)
+        packet.append(chr(0))
+
+        layout = [size for command, args, size, parser in batch.commands]
+        ret = self.comm.send_command(''.join(packet), self.command_i, first,
+                                     batch.parse, layout)
+        return ret
+
+
+    @actuator
+    def set_speed(self, left, right, callback=_identity):
         """Set the speed of the motors."""
         if (-self.MAX_SPEED <= left <= self.MAX_SPEED) \
         and (-self.MAX_SPEED <= right <= self.MAX_SPEED):
-            command = "D%c,%d,%d\n" % (self.command_i, left, right)
-            ret = self.comm.send_command(command, self.command_i, 'd', callback)
-            return ret
+            def _set_speed(response):
+                self.motor_speed = [left, right]
+                return callback(response)
+
+            return self._send('set_speed', (left, right),
+                    self._write_through('speed', (left, right), _set_speed),
+                    coalesce_key='D')
         else:
             raise WrongCommand("Speed is out of bounds.")
 
+    @cached('speed')
     @command
-    def get_speed(self, callback=lambda x: x):
+    def get_speed(self, callback=_identity):
         """Get speed of motors.
 
         The speed is measured in pulses per second, one pulse is
@@ -110,60 +599,46 @@ class Controller(object):
         Returns tuple (left motor speed, right motor speed).
 
         """
-        def _parse_response(response):
-            try:
-                left, right = response.strip().split(',')
-                return callback((int(left), int(right)))
-            except Exception as e:
-                self.logger.error(e)
-                raise ControllerError(e)
-
-        command = "E%c\n" % self.command_i
-        ret = self.comm.send_command(command, self.command_i, 'e', _parse_response)
-        return ret
+        return self._send('get_speed', callback=callback)
 
 
-    @command
-    def set_body_led(self, value, callback=lambda x: x):
+    @actuator
+    def set_body_led(self, value, callback=_identity):
         """Set the green body LED's status.
 
         Arguments:
             value - boolean, turn the led on.
 
         """
-        command = "B%c,%d\n" % (self.command_i, 1 if value else 0)
-        ret = self.comm.send_command(command, self.command_i, 'b', callback)
-        return ret
+        return self._send('set_body_led', (1 if value else 0,), callback,
+                          coalesce_key='B')
 
 
-    @command
-    def set_front_led(self, value, callback=lambda x: x):
+    @actuator
+    def set_front_led(self, value, callback=_identity):
         """Set the bright front LED's status.
 
         Arguments:
             value - boolean, turn the led on.
 
         """
-        command = "F%c,%d\n" % (self.command_i, 1 if value else 0)
-        ret = self.comm.send_command(command, self.command_i, 'f', callback)
-        return ret
+        return self._send('set_front_led', (1 if value else 0,), callback,
+                          coalesce_key='F')
 
 
     @command
-    def set_leds(self, value, callback=lambda x: x):
+    def set_leds(self, value, callback=_identity):
         """Set the all LEDs with one command.
 
         Arguments:
             value - boolean, turn the leds on.
 
         """
-        command = "L%c,9,%d\n" % (self.command_i, 1 if value else 0)
-        ret = self.comm.send_command(command, self.command_i, 'l', callback)
-        return ret
+        return self._send('set_led', (9, 1 if value else 0), callback)
 
 
-    @command
-    def set_led(self, led_no, value, callback=lambda x: x):
+    @actuator
+    def set_led(self, led_no, value, callback=_identity):
         """Set the LED's status.
 
         There are 8 LEDs on the e-puck robot. The LED number 0 is the frontal
@@ -175,36 +650,26 @@ class Controller(object):
 
         """
         if (0 <= led_no <= 7):
-            command = "L%c,%d,%d\n" % (self.command_i, led_no, 1 if value else 0)
-            ret = self.comm.send_command(command, self.command_i, 'l', callback)
-            return ret
+            return self._send('set_led', (led_no, 1 if value else 0), callback,
+                              coalesce_key=('L', led_no))
         else:
             raise WrongCommand("Led number is out of the bounds.")
 
 
+    @cached('selector')
     @command
-    def get_turning_selector(self, callback=lambda x: x):
+    def get_turning_selector(self, callback=_identity):
         """Get the position of the rotating 16 positions selector.
 
         Position 0 correspond to the arrow pointing on the right when looking
         in the same direction as the robot.
 
         """
-        def _parse_response(response):
-            try:
-                value = response.strip()
-                return callback(int(value))
-            except Exception as e:
-                self.logger.error(e)
-                raise ControllerError(e)
-
-        command = "C%c\n" % self.command_i
-        ret = self.comm.send_command(command, self.command_i, 'c', _parse_response)
-        return ret
+        return self._send('get_turning_selector', callback=callback)
 
 
     @command
-    def get_proximity_sensors(self, callback=lambda x: x):
+    def get_proximity_sensors(self, callback=_identity):
         """Get the values of the 8 proximity sensors.
 
         The 12 bit values of the 8 proximity sensors. For left and right side
@@ -212,31 +677,17 @@ class Controller(object):
         degrees and 90 degrees from the front. For each side there is also one
         sensor on the back side.
 
-        The keys for sensor values are following: L10, L45, L90, LB, R10, R45,
-        R90, RB.
+        The values are returned as a SensorValues record with keys L10,
+        L45, L90, LB, R10, R45, R90, RB.
 
         The values are in range [0, 4095].
 
         """
-        def _parse_response(response):
-            try:
-                r = map(int, response.split(','))
-                if len(r) != 8:
-                    raise ControllerError("Wrong response")
-
-                return callback(dict(zip(['R10', 'R45', 'R90', 'RB', 'LB', 'L90', 'L45',
-                                'L10'], r)))
-            except ValueError as e:
-                self.logger.error(e)
-                raise ControllerError(e)
-
-        command = "N%c\n" % self.command_i
-        ret = self.comm.send_command(command, self.command_i, 'n', _parse_response)
-        return ret
+        return self._send('get_proximity_sensors', callback=callback)
 
 
     @command
-    def get_ambient_sensors(self, callback=lambda x: x):
+    def get_ambient_sensors(self, callback=_identity):
         """Get the values of the 8 ambient light sensors.
 
         The 12 bit values of the 8 ambient light sensors. For left and right
@@ -244,31 +695,17 @@ class Controller(object):
         45 degrees and 90 degrees from the front. For each side there is also
         one sensor on the back side.
 
-        The keys for sensor values are following: L10, L45, L90, LB, R10, R45,
-        R90, RB.
+        The values are returned as a SensorValues record with keys L10,
+        L45, L90, LB, R10, R45, R90, RB.
 
         The values are in range [0, 4095].
 
         """
-        def _parse_response(response):
-            try:
-                r = map(int, response.split(','))
-                if len(r) != 8:
-                    raise ControllerError("Wrong response")
-
-                return callback(dict(zip(['R10', 'R45', 'R90', 'RB', 'LB', 'L90', 'L45',
-                                'L10'], r)))
-            except ValueError as e:
-                self.logger.error(e)
-                raise ControllerError(e)
-
-        command = "O%c\n" % self.command_i
-        ret = self.comm.send_command(command, self.command_i, 'o', _parse_response)
-        return ret
+        return self._send('get_ambient_sensors', callback=callback)
 
 
     @command
-    def set_camera(self, mode, width, height, zoom, callback=lambda x: x):
+    def set_camera(self, mode, width, height, zoom, callback=_identity):
         """Set the camera properties.
 
         If the common denominator of zoom factor is 4 or 2, part of the
@@ -283,14 +720,15 @@ class Controller(object):
             zoom - zoom factor
         """
         if 0 < width <= 640 and 0 < height <= 480 and mode in (self.GREYSCALE_MODE, self.RGB565_MODE):
-            command = "J%c,%d,%d,%d,%d\n" % (self.command_i, mode, width, height, zoom)
-            ret = self.comm.send_command(command, self.command_i, 'j', callback)
-            return ret
+            camera = {'mode': mode, 'width': width, 'height': height, 'zoom': zoom}
+            return self._send('set_camera', (mode, width, height, zoom),
+                    self._write_through('camera', camera, callback))
         else:
             raise WrongCommand("Wrong camera properties.")
 
+    @cached('camera')
     @command
-    def get_camera(self, callback=lambda x: x):
+    def get_camera(self, callback=_identity):
         """Get the camera properties.
 
         Returns a dictionary with camera properties. The properites are:
@@ -300,58 +738,72 @@ class Controller(object):
             zoom - zoom factor
 
         """
-        def _parse_response(response):
-            try:
-                r = map(int, response.strip().split(','))
-                return callback(dict(zip(['mode', 'width', 'height', 'zoom'], r)))
-            except ValueError as e:
-                self.logger.error(e)
-                raise ControllerError(e)
-
-        command = "I%c\n" % self.command_i
-        ret = self.comm.send_command(command, self.command_i, 'i', _parse_response)
-        return ret
+        return self._send('get_camera', callback=callback)
 
     @command
-    def get_photo(self, callback=lambda x: x):
+    def get_photo(self, callback=_identity):
         """Take a photo."""
+        return self._send('get_photo', callback=callback)
+
+
+    @command
+    def _request_frame(self):
+        """Take a photo for the stream."""
+        sent_at = time.time()
         def _parse_response(response):
-            mode = ord(response[0])
-            width = ord(response[1]) + (ord(response[2]) << 8);
-            height = ord(response[3]) + (ord(response[4]) << 8);
-            image = response[5:]
-
-            if mode == self.RGB565_MODE:
-                ret = ""
-                data_struct = "<BBB"
-
-                for (hi, lo) in zip(image[0::2], image[1::2]):
-                    val = (ord(hi) << 8) + ord(lo)
-                    b = int(((val >> 11) & 31) / 31. * 255)
-                    g = int(((val >> 5) & 63) / 63. * 255)
-                    r = int((val & 31) / 31. * 255)
-                    ret += struct.pack(data_struct, b, g, r)
-                return callback(Image.fromstring('RGB', (width, height), ret).rotate(90))
-
-            elif mode == self.GREYSCALE_MODE:
-                return callback(Image.fromstring('L', (width, height), image).rotate(90))
-
-        c = self._binary_command("I")
-        command = "%c%c%c" % (c, self.command_i, chr(0))
-        ret = self.comm.send_command(command, self.command_i, c, _parse_response)
-        return ret
+            received_at = time.time()
+            return Frame(_decode_photo(response), sent_at, received_at)
+
+        return self._send('get_photo', decoder=_parse_response)
+
+    def stream_photos(self, depth=2, drop=False):
+        """Take photos continuously.
+
+        Return an iterator of Frame objects. While the caller processes a
+        frame, depth - 1 more photos are being taken, so the connection
+        doesn't idle. With the synchronous communication the photos are
+        taken one by one when asked for.
+
+        Arguments:
+            depth -- How many photos can be requested at once.
+            drop -- Set True to skip the older frames, if more of them have
+                already been received when the next one is asked for.
+
+        """
+        from comm.sync import SyncComm
+        if isinstance(self.comm, SyncComm):
+            while True:
+                yield _streamed(self._request_frame())
+
+        requests = collections.deque()
+        try:
+            for i in range(depth):
+                requests.append(_streamed(self._request_frame()))
+            while True:
+                frame = requests.popleft().get_response()
+                requests.append(_streamed(self._request_frame()))
+
+                while drop and requests[0].done():
+                    frame = requests.popleft().get_response()
+                    requests.append(_streamed(self._request_frame()))
+
+                yield frame
+        finally:
+            # Nobody waits for the photos anymore, don't take them again.
+            for request in requests:
+                request.cancel()
 
 
     @command
-    def reset(self, callback=lambda x: x):
+    def reset(self, callback=_identity):
         """Reset the robot."""
-        command = "R%c\n" % self.command_i
-        ret = self.comm.send_command(command, self.command_i, 'r', callback)
-        return ret
+        if self.cache is not None:
+            self.cache.invalidate()
+        return self._send('reset', callback=callback)
 
 
     @command
-    def set_motor_pos(self, left, right, callback=lambda x: x):
+    def set_motor_pos(self, left, right, callback=_identity):
         """Set motor position.
 
         The robot has two step motors. It is possible to set initial positions
@@ -365,52 +817,30 @@ class Controller(object):
             right - position of right motor
 
         """
-        command = "P%c,%d,%d\n" % (self.command_i, left, right)
-        ret = self.comm.send_command(command, self.command_i, 'p', callback)
-        return ret
+        return self._send('set_motor_pos', (left, right), callback)
 
     @command
-    def get_motor_pos(self, callback=lambda x: x):
+    def get_motor_pos(self, callback=_identity):
         """Read motor position.
 
         Returns two values, position of left and right motor.
         """
-        def _parse_response(response):
-            try:
-                r = map(int, response.strip().split(','))
-                return callback(r)
-            except ValueError as e:
-                self.logger.error(e)
-                raise ControllerError(e)
-
-        command = "Q%c\n" % (self.command_i)
-        ret = self.comm.send_command(command, self.command_i, 'q', _parse_response)
-        return ret
+        return self._send('get_motor_pos', callback=callback)
 
 
     @command
-    def get_raw_accelerometer(self, callback=lambda x: x):
+    def get_raw_accelerometer(self, callback=_identity):
         """Read accelerometer data.
 
         Accelerometer measures acceleration in three axis (x, y, z).
 
-        Returns data as a dict with three keys: 'x', 'y' and 'z'.
+        Returns an Acceleration record with three keys: 'x', 'y' and 'z'.
 
         """
-        def _parse_response(response):
-            try:
-                r = dict(zip(['x', 'y', 'z'], map(int, response.strip().split(','))))
-                return callback(r)
-            except ValueError as e:
-                self.logger.error(e)
-                raise ControllerError(e)
-
-        command = "A%c\n" % (self.command_i)
-        ret = self.comm.send_command(command, self.command_i, 'a', _parse_response)
-        return ret
+        return self._send('get_raw_accelerometer', callback=callback)
 
     @command
-    def get_accelerometer(self, callback=lambda x: x):
+    def get_accelerometer(self, callback=_identity):
         """Read the acceleration vector in spherical coords.
 
         Three values can be computed from the acceleration sensors:
@@ -436,48 +866,36 @@ class Controller(object):
                 270° = right part lower than left part
 
         """
-        def _parse_response(response):
-            try:
-                acceleration = struct.unpack('<f', response[:4])[0]
-                orientation = struct.unpack('<f', response[4:8])[0]
-                inclination = struct.unpack('<f', response[8:12])[0]
-                return callback({'acceleration': acceleration, 'orientation':
-                    orientation, 'inclination': inclination})
-            except struct.error as e:
-                self.logger.error(e)
-                raise ControllerError(e)
-
-        c = self._binary_command("A")
-        command = "%c%c%c" % (c, self.command_i, chr(0))
-        ret = self.comm.send_command(command, self.command_i, c, _parse_response)
-        return ret
+        return self._send('get_accelerometer', callback=callback)
 
 
     @command
-    def calibrate_sensors(self, callback=lambda x: x):
+    def calibrate_sensors(self, callback=_identity):
         """Calibrate proximity sensors.
 
         Remove any objects in sensors range.
 
         """
-        command = "K%c\n" % (self.command_i)
-        ret = self.comm.send_command(command, self.command_i, 'k', callback)
-        return ret
+        return self._send('calibrate_sensors', callback=callback)
 
 
-    @command
-    def stop(self, callback=lambda x: x):
+    @actuator
+    def stop(self, callback=_identity):
         """Stop the robot.
 
-        Stop the motors and turn off all leds.
+        Stop the motors and turn off all leds. The stop is never replaced
+        by a speed set later, so the leds are always turned off.
 
         """
-        command = "S%c\n" % (self.command_i)
-        ret = self.comm.send_command(command, self.command_i, 's', callback)
-        return ret
+        def _stop(response):
+            self.motor_speed = [0, 0]
+            return callback(response)
+
+        return self._send('stop', (), self._write_through('speed', (0, 0), _stop),
+                          coalesce_key='S')
 
     @command
-    def play_sound(self, sound_no, callback=lambda x: x):
+    def play_sound(self, sound_no, callback=_identity):
         """Play sound.
 
         The robot is capable of playing 5 sounds, their numbers are:
@@ -492,13 +910,11 @@ class Controller(object):
         white noise).
 
         """
-        command = "T%c,%d\n" % (self.command_i, sound_no)
-        ret = self.comm.send_command(command, self.command_i, 't', callback)
-        return ret
+        return self._send('play_sound', (sound_no,), callback)
 
 
     @command
-    def get_volume(self, callback=lambda x: x):
+    def get_volume(self, callback=_identity):
         """Read volumes from microphones.
 
         There are three microphones on the top of the robot.
@@ -508,35 +924,93 @@ class Controller(object):
             MIC 1 -- left side
             MIC 2 -- back
 
-        The returned value is a tuple of three volumes.
+        The returned value is a Volume record with keys 'R', 'L' and 'B'.
 
         """
-        def _parse_response(response):
-            try:
-                r = dict(zip(['R', 'L', 'B'], map(int, response.strip().split(','))))
-                return callback(r)
-            except ValueError as e:
-                self.logger.error(e)
-                raise ControllerError(e)
-
-        command = "U%c\n" % (self.command_i)
-        ret = self.comm.send_command(command, self.command_i, 'u', _parse_response)
-        return ret
+        return self._send('get_volume', callback=callback)
 
 
     @command
-    def get_microphone(self, on, callback=lambda x: x):
+    def get_microphone(self, on, callback=_identity):
         """Perform FFT on data from microphones and return the results.
 
         Arguments:
             on -- turn recording on/off
 
         """
-        def _parse_response(response):
-            return [ord(x) + ord(y) * 1j for x,y in zip(response[::2], response[1::2])]
-        d = {'command': self._binary_command('Z'), 'timestamp': self.command_i,
-             'on': '1' if on else '0'}
-        command = "%(command)c%(timestamp)c%(on)c\x00" % d
-        ret = self.comm.send_command(command, self.command_i, d['command'], _parse_response)
-        return ret
+        return self._send('get_microphone', ('1' if on else '0',), callback)
+
+    @command
+    def _request_fft(self):
+        """Request the next FFT block decoded into a NumPy array."""
+        return self._send('get_microphone', ('1',), decoder=audio.decode_fft)
+
+    def stream_microphone(self, depth=2, spectrogram=None):
+        """Perform FFT on data from microphones continuously.
 
+        Return an iterator of complex NumPy arrays, one FFT block from the
+        microphone each (see audio.decode_fft). While the caller processes
+        a block, depth - 1 more requests are waiting in the robot, so it
+        starts the next acquisition right after sending a block and the
+        link runs at its full rate. With the synchronous communication the
+        blocks are requested one by one when asked for. Recording stays on
+        until get_microphone(False) is called.
+
+        Arguments:
+            depth -- How many blocks can be requested at once.
+            spectrogram -- audio.Spectrogram where the blocks are appended.
+
+        """
+        from comm.sync import SyncComm
+        if isinstance(self.comm, SyncComm):
+            while True:
+                block = _streamed(self._request_fft())
+                if spectrogram is not None:
+                    spectrogram.append(block)
+                yield block
+
+        requests = collections.deque()
+        try:
+            for i in range(depth):
+                requests.append(_streamed(self._request_fft()))
+            while True:
+                block = requests.popleft().get_response()
+                requests.append(_streamed(self._request_fft()))
+
+                if spectrogram is not None:
+                    spectrogram.append(block)
+                yield block
+        finally:
+            # Nobody waits for the blocks anymore, don't request them again.
+            for request in requests:
+                request.cancel()
+
+
+
+def _controller_method(protocol_command):
+    """Return the Controller method sending the command."""
+    def _send_command(self, *args, **kwargs):
+        return self._send(protocol_command.name, args,
+                          kwargs.get('callback', _identity))
+    _send_command.__name__ = protocol_command.name
+    _send_command.__doc__ = protocol_command.doc
+    return command(_send_command)
+
+
+def _batch_method(protocol_command):
+    """Return the BinaryBatch method adding the command to the packet."""
+    def _add_command(self, *args):
+        return self._add(protocol_command.name, args)
+    _add_command.__name__ = protocol_command.name
+    _add_command.__doc__ = "Add the command %s to the packet." % protocol_command.name
+    return _add_command
+
+
+for _protocol_command in COMMANDS.itervalues():
+    if not hasattr(Controller, _protocol_command.name):
+        setattr(Controller, _protocol_command.name,
+                _controller_method(_protocol_command))
+    if _protocol_command.binary and not hasattr(BinaryBatch, _protocol_command.name):
+        setattr(BinaryBatch, _protocol_command.name,
+                _batch_method(_protocol_command))
+del _protocol_command
@@ -0,0 +1,459 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import math
+import os
+import pty
+import Queue
+import random
+import re
+import struct
+import threading
+import time
+import tty
+
+from epuck.comm.socketpair import create_socket_pair
+
+
+class Emulator(object):
+    """Emulate e-puck robot running the BTcomDM firmware.
+
+    The emulator speaks the text and binary protocol of firmware/BTcomDM.c:
+    timestamps, ignoring a command with the same timestamp as the previous
+    one (a binary packet is answered again), size headers of binary answers, several binary commands in one
+    packet and the 'z' answer to unknown commands. The robot's sensors are
+    plain attributes which can be changed while the emulator runs.
+
+    The robot is connected either through a pseudo terminal, whose path is
+    in the port attribute and can be given to Controller, or through a
+    socket pair, whose host end is in the socket attribute.
+
+    The link can be slowed down. Every message (a chunk of data from the host
+    or an answer of the robot) is sent as soon as the previous one has been
+    transmitted with given bandwidth and it arrives latency seconds later.
+    A command or an answer is lost with given probability.
+
+    Usage:
+        emulator = Emulator(bandwidth=11520, latency=0.01)
+        emulator.start()
+        controller = Controller(emulator.port)
+
+    """
+
+    # Size of the FFT computed by the robot.
+    FFT_BLOCK_LENGTH = 64
+    # Number of argument bytes following the binary commands.
+    BINARY_ARGUMENTS = {'Z': 1, 'D': 4, 'L': 2}
+    # Argument of a text command as read by sscanf.
+    NUMBER = re.compile(r',\s*([-+]?\d+)')
+
+    GREYSCALE_MODE = 0
+    RGB565_MODE = 1
+
+    def __init__(self, bandwidth=None, latency=0, loss=0, transport='pty',
+                 seed=None):
+        """Create new emulator.
+
+        Arguments:
+            bandwidth -- Bytes per second transmitted in each direction, None
+                means unlimited.
+            latency -- Time in seconds a message travels over the link.
+            loss -- Probability that a command or an answer is lost.
+            transport -- 'pty' or 'socketpair'.
+            seed -- Seed for the random generator deciding about losses.
+
+        """
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+
+        if transport == 'pty':
+            self.fd, self.slave_fd = pty.openpty()
+            tty.setraw(self.slave_fd)
+            self.port = os.ttyname(self.slave_fd)
+            self.socket = None
+            self._recv = lambda: os.read(self.fd, 4096)
+            self._send = lambda data: os.write(self.fd, data)
+        elif transport == 'socketpair':
+            self.socket, self.robot_socket = create_socket_pair()
+            self.port = None
+            self._recv = lambda: self.robot_socket.recv(4096)
+            self._send = self.robot_socket.sendall
+        else:
+            raise ValueError("Unknown transport: %s" % transport)
+
+        # Stored are tuples (time of delivery, data) or None to stop.
+        self.incoming = Queue.Queue()
+        self.outgoing = Queue.Queue()
+        self.input_data = collections.deque()
+        self.uplink_free = 0
+        self.downlink_free = 0
+        self.running = False
+
+        # Counters of transferred data.
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.commands = 0
+
+        self.logger = logging.getLogger('Emulator')
+
+        # Sensors of the robot.
+        self.proximity = [10, 20, 30, 40, 50, 60, 70, 80]
+        self.ambient = [3000, 3100, 3200, 3300, 3400, 3500, 3600, 3700]
+        self.accelerometer = [2000, 2100, 2600]
+        self.selector = 0
+        self.volume = [10, 20, 30]
+
+        self.reset()
+
+    def reset(self):
+        """Set the state of the robot as after power on."""
+        self.speed = [0, 0]
+        self.steps = [0.0, 0.0]
+        self.steps_updated = time.time()
+        self.leds = 8 * [0]
+        self.body_led = 0
+        self.front_led = 0
+        self.sound = 0
+        self.listening = False
+        self.timestamp = None
+        self.last_timestamp = None
+        # The last binary answer, sent again for a packet with the same
+        # timestamp. Text commands overwrite it in the firmware's buffer.
+        self.last_answer = None
+        self.set_camera(self.RGB565_MODE, 40, 40, 8)
+
+    def set_camera(self, mode, width, height, zoom):
+        """Configure the camera and prepare the image it sees."""
+        self.camera = [mode, width, height, zoom]
+        if mode == self.GREYSCALE_MODE:
+            self.camera_size = width * height
+            self.image = ''.join(chr((i * 7) & 0xff) for i in xrange(self.camera_size))
+        else:
+            self.camera_size = width * height * 2
+            self.image = ''.join(struct.pack('>H', (i * 37) & 0xffff)
+                                 for i in xrange(self.camera_size // 2))
+
+    def start(self):
+        """Start the threads emulating the robot and the link."""
+        self.running = True
+        for target in (self._receive, self._run, self._transmit):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop the emulator."""
+        self.running = False
+        self.incoming.put(None)
+        self.outgoing.put(None)
+
+    # The link
+
+    def _delay(self, size, free):
+        """Return when a message of given size sent now will arrive.
+
+        The free argument is the time when the link finishes the previous
+        transmission. Return also the new value of free.
+
+        """
+        start = max(time.time(), free)
+        if self.bandwidth:
+            start += float(size) / self.bandwidth
+        return start + self.latency, start
+
+    def _lost(self):
+        """Decide whether a message is lost."""
+        return self.loss and self.random.random() < self.loss
+
+    def _receive(self):
+        """Read data sent by the host and pass them to the robot."""
+        while self.running:
+            try:
+                data = self._recv()
+            except (OSError, IOError):
+                break
+            if not data:
+                break
+            self.bytes_in += len(data)
+            delivery, self.uplink_free = self._delay(len(data), self.uplink_free)
+            self.incoming.put((delivery, data))
+        self.incoming.put(None)
+
+    def _transmit(self):
+        """Send the answers of the robot to the host."""
+        while True:
+            message = self.outgoing.get()
+            if message is None:
+                break
+            delivery, data = message
+            wait = delivery - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self._send(data)
+            except (OSError, IOError):
+                break
+            self.bytes_out += len(data)
+
+    def _write(self, data):
+        """Send the answer through the link."""
+        if self._lost():
+            self.logger.debug('Answer lost: %r' % data)
+            return
+        delivery, self.downlink_free = self._delay(len(data), self.downlink_free)
+        self.outgoing.put((delivery, data))
+
+    def _write_text(self, text):
+        """Send the text answer, it ends with the first NUL like in C."""
+        self._write(text.split('\0', 1)[0])
+
+    def _getchar(self):
+        """Return next char received by the robot."""
+        while not self.input_data:
+            message = self.incoming.get()
+            if message is None:
+                raise EOFError()
+            delivery, data = message
+            wait = delivery - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.input_data.extend(data)
+        return self.input_data.popleft()
+
+    # The robot
+
+    def _run(self):
+        """The main loop of the firmware."""
+        try:
+            while True:
+                c = self._getchar()
+                if ord(c) >= 128:
+                    self._binary_mode(c)
+                elif c != '\0':
+                    self._ascii_mode(c)
+        except EOFError:
+            pass
+
+    def _binary_mode(self, c):
+        """Process the packet of binary commands starting with c."""
+        timestamp = self._getchar()
+        answer = [c, timestamp]
+        duplicate = timestamp == self.last_timestamp
+        lost = self._lost()
+
+        while ord(c) >= 128:
+            command = chr(256 - ord(c))
+            arguments = ''.join(self._getchar() for i in
+                                range(self.BINARY_ARGUMENTS.get(command, 0)))
+            if not duplicate and not lost:
+                self.commands += 1
+                answer.append(self._binary_command(command, arguments))
+            c = self._getchar()
+
+        if lost:
+            return
+        if not duplicate:
+            self.last_answer = ''.join(answer)
+        if self.last_answer is not None:
+            # A repeated packet is answered again, its answer has been lost.
+            self._write(self.last_answer)
+        self.last_timestamp = timestamp
+
+    def _ascii_mode(self, c):
+        """Process the text command starting with c."""
+        line = ''
+        if c not in '\r\n':
+            self.timestamp = self._getchar()
+            char = self.timestamp
+            while char not in '\r\n':
+                char = self._getchar()
+                line += char
+        else:
+            char = c
+        command = c.upper()
+
+        if self._lost():
+            self.logger.debug('Command lost: %r' % command)
+            return
+
+        if self.timestamp != self.last_timestamp:
+            self.commands += 1
+            self._ascii_command(command, line, char)
+        self.last_timestamp = self.timestamp
+        self.last_answer = None
+
+    def _update_steps(self):
+        """Move the motors according to the speed."""
+        now = time.time()
+        for i in (0, 1):
+            self.steps[i] += self.speed[i] * (now - self.steps_updated)
+        self.steps_updated = now
+
+    def _get_steps(self):
+        """Return the motor positions as 16 bit signed numbers."""
+        self._update_steps()
+        return [(int(s) + 0x8000) % 0x10000 - 0x8000 for s in self.steps]
+
+    def _spheric_accelerometer(self):
+        """Compute acceleration, orientation and inclination."""
+        x, y, z = [a - 2048 for a in self.accelerometer]
+        acceleration = math.sqrt(x * x + y * y + z * z)
+        if acceleration == 0:
+            return 0., 0., 0.
+        inclination = 90 - math.degrees(math.atan2(z, math.sqrt(x * x + y * y)))
+        orientation = math.degrees(math.atan2(y, x)) % 360
+        return acceleration, orientation, inclination
+
+    def _fft(self):
+        """Return FFT of the microphone data as pairs of signed chars."""
+        return ''.join(struct.pack('<bb', (i * 13) % 256 - 128, (i * 29) % 256 - 128)
+                       for i in range(self.FFT_BLOCK_LENGTH // 2))
+
+    def _binary_command(self, command, arguments):
+        """Execute the binary command and return the answer."""
+        def words(values):
+            return struct.pack('<%dh' % len(values), *values)
+
+        if command == 'Z':
+            if arguments == '0':
+                self.listening = False
+                return '\x00\x00'
+            elif arguments == '1':
+                self.listening = True
+                return struct.pack('<H', self.FFT_BLOCK_LENGTH) + self._fft()
+            return ''
+        elif command == 'a':
+            return words(self.accelerometer)
+        elif command == 'A':
+            return '\x0c\x00' + struct.pack('<fff', *self._spheric_accelerometer())
+        elif command == 'D':
+            self._update_steps()
+            self.speed = list(struct.unpack('<hh', arguments))
+        elif command == 'E':
+            return words(self.speed)
+        elif command == 'I':
+            mode, width, height, zoom = self.camera
+            return struct.pack('<HBHH', self.camera_size + 5, mode, width,
+                               height) + self.image
+        elif command == 'L':
+            led, value = ord(arguments[0]), ord(arguments[1])
+            if led == 8:
+                self.body_led = value
+            elif led == 9:
+                self.front_led = value
+            else:
+                self._set_led(led, value)
+        elif command == 'M':
+            return 6 * '\x00'
+        elif command == 'N':
+            return words(self.proximity)
+        elif command == 'O':
+            return words(self.ambient)
+        elif command == 'Q':
+            return words(self._get_steps())
+        elif command == 'u':
+            return words(self.volume)
+        elif command == 'U':
+            # The microphone buffer is sent before the answer.
+            self._write(600 * '\x00')
+            return '\x00'
+        return ''
+
+    def _set_led(self, led, value):
+        """Set the LED like e_set_led, numbers above 7 mean all LEDs."""
+        leds = range(8) if not 0 <= led <= 7 else [led]
+        for i in leds:
+            self.leds[i] = (1 - self.leds[i]) if value == 2 else value
+
+    def _scan(self, line, values):
+        """Read comma separated integers like sscanf.
+
+        Return the values with the ones that were read replaced.
+
+        """
+        values = list(values)
+        position = 0
+        for i in range(len(values)):
+            match = self.NUMBER.match(line, position)
+            if match is None:
+                break
+            values[i] = int(match.group(1))
+            position = match.end()
+        return values
+
+    def _ascii_command(self, command, line, terminator):
+        """Execute the text command and send the answer."""
+        ts = self.timestamp if self.timestamp is not None else '\0'
+
+        if command == 'A':
+            self._write_text('a%s,%d,%d,%d\r\n' % ((ts,) + tuple(self.accelerometer)))
+        elif command == 'B':
+            self.body_led, = self._scan(line, [self.body_led])
+            self._write_text('b%s\r\n' % ts)
+        elif command == 'C':
+            self._write_text('c%s,%d\r\n' % (ts, self.selector))
+        elif command == 'D':
+            self._update_steps()
+            self.speed = self._scan(line, self.speed)
+            self._write_text('d%s\r\n' % ts)
+        elif command == 'E':
+            self._write_text('e%s,%d,%d\r\n' % (ts, self.speed[0], self.speed[1]))
+        elif command == 'F':
+            self.front_led, = self._scan(line, [self.front_led])
+            self._write_text('f%s\r\n' % ts)
+        elif command == 'G':
+            self._write_text('g IR check : 0x0, address : 0x0, data : 0x0\r\n')
+        elif command == 'H':
+            self._write_text('\n"H"\t     Help\r\n')
+        elif command == 'I':
+            self._write_text('i%s,%d,%d,%d,%d,%d\r\n' % ((ts,) + tuple(self.camera)
+                                                        + (self.camera_size,)))
+        elif command == 'J':
+            self.set_camera(*self._scan(line, self.camera))
+            self._write_text('j%s\r\n' % ts)
+        elif command == 'K':
+            self._write_text('k%s\r\n' % ts)
+        elif command == 'L':
+            led, value = self._scan(line, [0, 0])
+            self._set_led(led, value)
+            self._write_text('l%s\r\n' % ts)
+        elif command == 'M':
+            self._write_text('m%s,0,0,0\r\n' % ts)
+        elif command == 'N':
+            self._write_text(('n%s' + 8 * ',%d' + '\r\n') % ((ts,) + tuple(self.proximity)))
+        elif command == 'O':
+            self._write_text(('o%s' + 8 * ',%d' + '\r\n') % ((ts,) + tuple(self.ambient)))
+        elif command == 'P':
+            self._update_steps()
+            self.steps = [float(s) for s in self._scan(line, self._get_steps())]
+            self._write_text('p%s\r\n' % ts)
+        elif command == 'Q':
+            self._write_text('q%s,%d,%d\r\n' % ((ts,) + tuple(self._get_steps())))
+        elif command == 'R':
+            self._write_text('r%s\r\n' % ts)
+            self._write_text('\n')
+            self.reset()
+        elif command == 'S':
+            self._update_steps()
+            self.speed = [0, 0]
+            self._set_led(8, 0)
+            self._write_text('s%s\r\n' % ts)
+        elif command == 'T':
+            self.sound, = self._scan(line, [self.sound])
+            self._write_text('t%s\r\n' % ts)
+        elif command == 'U':
+            self._write_text('u%s,%d,%d,%d\r\n' % ((ts,) + tuple(self.volume)))
+        elif command == 'V':
+            self._write_text('v%s, DM Version 0.3 2011\r\n' % ts)
+        elif command == 'W':
+            # The sensor turret is not present.
+            pass
+        elif command == 'X':
+            size, = self._scan(line, [0])
+            self._write_text('x%s,%s\r\n' % (ts, '1' * size))
+        else:
+            self._write_text('z%s,Command %d not found\r\n' % (ts, ord(terminator)))
@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import array
+import struct
+import sys
+
+# Stored are RGB triples (as strings) for all RGB565 values.
+_rgb565_table = None
+
+
+def _create_rgb565_table():
+    """Compute the RGB triple for every possible RGB565 value."""
+    data_struct = struct.Struct("<BBB")
+    table = []
+    for val in xrange(1 << 16):
+        b = int(((val >> 11) & 31) / 31. * 255)
+        g = int(((val >> 5) & 63) / 63. * 255)
+        r = int((val & 31) / 31. * 255)
+        table.append(data_struct.pack(b, g, r))
+    return table
+
+
+def rgb565_to_rgb(data):
+    """Convert RGB565 image data to 24 bit RGB data.
+
+    The camera sends every pixel as a 16 bit big endian number. Instead of
+    computing the colors pixel by pixel, the pixels are read into an array at
+    once and every value is looked up in a table computed on the first call.
+    The data can be a string or a memoryview.
+
+    """
+    global _rgb565_table
+    if _rgb565_table is None:
+        _rgb565_table = _create_rgb565_table()
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    pixels = array.array('H', data)
+    if sys.byteorder == 'little':
+        pixels.byteswap()
+    return ''.join(map(_rgb565_table.__getitem__, pixels))
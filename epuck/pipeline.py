@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import ctypes
+import logging
+import multiprocessing
+import Queue
+import traceback
+
+import Image
+
+from epuck import EPuckError
+
+
+class PipelineError(EPuckError):
+    """The analysis of a frame failed in a worker process."""
+    pass
+
+
+def _work(function, slots, tasks, results):
+    """Analyse the frames in a worker process."""
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, index, mode, size, length = task
+        try:
+            image = Image.fromstring(mode, size, slots[index][:length])
+            results.put((seq, index, function(image), None))
+        except Exception:
+            results.put((seq, index, None, traceback.format_exc()))
+
+
+class Pipeline(object):
+    """Analyse photos in worker processes while next photos are taken.
+
+    The function analysing a photo gets a PIL image and runs in one of the
+    worker processes, so more photos are analysed at once and the thread
+    taking the photos isn't slowed down. The photos are passed to the
+    workers through shared memory, only the results are pickled.
+
+    Results are returned in the order of the photos. If only the latest
+    result matters (e.g. when the robot reacts to what it sees), create the
+    pipeline with ordered=False. Photos that come while all workers are busy
+    are then skipped and older results are dropped once a newer one is
+    available.
+
+    Usage:
+        pipeline = Pipeline(find_faces)
+        for frame, faces in pipeline.process(controller.stream_photos()):
+            ...
+        pipeline.close()
+
+    """
+
+    def __init__(self, function, processes=None, slots=None, ordered=True,
+                 slot_size=64 * 1024):
+        """Start the worker processes.
+
+        Arguments:
+            function -- Called with the image, returns a picklable result.
+            processes -- Number of worker processes, the number of CPUs by
+                default.
+            slots -- How many photos can be waiting or analysed at once,
+                twice the number of processes by default.
+            ordered -- Set False to get only the latest results.
+            slot_size -- Maximum size of the image data in bytes.
+
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if slots is None:
+            slots = 2 * processes
+
+        self.ordered = ordered
+        self.slot_size = slot_size
+        self.slots = [multiprocessing.RawArray(ctypes.c_char, slot_size)
+                      for i in range(slots)]
+        self.free_slots = range(slots)
+
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.workers = []
+        for i in range(processes):
+            worker = multiprocessing.Process(target=_work, args=(function,
+                                             self.slots, self.tasks, self.results))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        # Stored are frames being analysed under their sequence numbers.
+        self.frames = {}
+        # Stored are tuples (frame, result, error) under sequence numbers.
+        self.finished = {}
+        self.submitted = 0
+        self.next_result = 0
+        self.skipped = 0
+
+        self.logger = logging.getLogger('Pipeline')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the worker processes."""
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def submit(self, frame):
+        """Pass the frame (or an image) to the workers.
+
+        Return False if all slots are taken and the frame can't be accepted.
+
+        """
+        if not self.free_slots:
+            return False
+
+        image = getattr(frame, 'image', frame)
+        data = image.tobytes() if hasattr(image, 'tobytes') else image.tostring()
+        if len(data) > self.slot_size:
+            raise PipelineError("The image has %d bytes, slots have only %d."
+                                % (len(data), self.slot_size))
+
+        index = self.free_slots.pop()
+        ctypes.memmove(self.slots[index], data, len(data))
+        seq = self.submitted
+        self.submitted += 1
+        self.frames[seq] = frame
+        self.tasks.put((seq, index, image.mode, image.size, len(data)))
+        return True
+
+    def poll(self, block=False):
+        """Return a list of finished tuples (frame, result).
+
+        With ordered results only the ones following the previously returned
+        result are returned, otherwise only the latest one. Raise
+        PipelineError if the analysis has failed.
+
+        """
+        self._receive(block)
+        while not self.results.empty():
+            self._receive(False)
+
+        if self.ordered:
+            ready = []
+            while self.next_result in self.finished:
+                ready.append(self.finished.pop(self.next_result))
+                self.next_result += 1
+        else:
+            ready = []
+            if self.finished:
+                latest = max(self.finished)
+                ready.append(self.finished[latest])
+                self.finished.clear()
+                self.next_result = latest + 1
+
+        return [self._result(finished) for finished in ready]
+
+    def pending(self):
+        """Return the number of frames whose results haven't been returned."""
+        return len(self.frames) + len(self.finished)
+
+    def process(self, frames):
+        """Analyse the frames and yield tuples (frame, result).
+
+        The frames are taken from the iterable as fast as the workers accept
+        them, see the class documentation for the order of the results.
+
+        """
+        for frame in frames:
+            if self.ordered:
+                while not self.submit(frame):
+                    for result in self.poll(block=True):
+                        yield result
+            elif not self.submit(frame):
+                self.skipped += 1
+
+            for result in self.poll():
+                yield result
+
+        while self.pending():
+            for result in self.poll(block=True):
+                yield result
+
+    def _receive(self, block):
+        """Read one result from the workers and free its slot."""
+        if not self.frames:
+            return
+        try:
+            seq, index, result, error = self.results.get(block)
+        except Queue.Empty:
+            return
+        self.free_slots.append(index)
+        frame = self.frames.pop(seq)
+        if self.ordered or seq >= self.next_result:
+            self.finished[seq] = (frame, result, error)
+
+    def _result(self, finished):
+        frame, result, error = finished
+        if error is not None:
+            raise PipelineError(error)
+        return frame, result
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+
+
+class Record(tuple):
+    """Values read from the robot, accessible by their names.
+
+    The record is a tuple, so it's as cheap as the values unpacked from the
+    response, but it can be read like a dictionary as well::
+
+        >>> sensors = controller.get_proximity_sensors()
+        >>> sensors['L10'], sensors[0]
+        (125, 125)
+
+    The operator in, keys(), get() and items() work with the names like on
+    a dictionary. Unlike a dictionary, iterating over the record yields the
+    values, iterate over keys() or items() to get the names.
+
+    """
+
+    __slots__ = ()
+
+    # Names of the values, set by the subclasses.
+    FIELDS = ()
+    # Stored are positions of the values under their names.
+    INDEX = {}
+
+    def __new__(cls, values):
+        return tuple.__new__(cls, values)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                key = self.INDEX[key]
+            except KeyError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % item for item in self.items()))
+
+    def __contains__(self, key):
+        return key in self.INDEX
+
+    def __getnewargs__(self):
+        return (tuple(self),)
+
+    def get(self, key, default=None):
+        """Return the value with given name or default."""
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+
+    def keys(self):
+        """Return the names of the values."""
+        return list(self.FIELDS)
+
+    def has_key(self, key):
+        """Return True if there is a value with given name."""
+        return key in self.INDEX
+
+    def values(self):
+        """Return the list of values."""
+        return list(self)
+
+    def items(self):
+        """Return the list of tuples (name, value)."""
+        return zip(self.FIELDS, self)
+
+    def as_dict(self):
+        """Return the values in a dictionary."""
+        return dict(self.items())
+
+
+def record_type(name, fields):
+    """Create a subclass of Record with given names of values."""
+    fields = tuple(fields)
+    return type(name, (Record,), {
+        '__slots__': (),
+        'FIELDS': fields,
+        'INDEX': dict((field, i) for i, field in enumerate(fields)),
+        # Records are pickled by the name of the module creating the type.
+        '__module__': sys._getframe(1).f_globals.get('__name__', '__main__'),
+    })
+
+
+# Names of the proximity and ambient light sensors in the order the robot
+# sends them.
+SENSOR_NAMES = ['R10', 'R45', 'R90', 'RB', 'LB', 'L90', 'L45', 'L10']
+
+SensorValues = record_type('SensorValues', SENSOR_NAMES)
+Acceleration = record_type('Acceleration', ['x', 'y', 'z'])
+Volume = record_type('Volume', ['R', 'L', 'B'])
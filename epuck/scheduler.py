@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from epuck.controller import BinaryBatch
+
+
+class Subscription(object):
+    """Periodic reading of one sensor requested by one consumer."""
+
+    def __init__(self, sensor, period, callback):
+        self.sensor = sensor
+        self.period = period
+        self.callback = callback
+        self.next_due = 0
+        # Whether the consumer waits for the value being read.
+        self.waiting = False
+
+
+class SensorScheduler(object):
+    """Read sensors of one robot periodically and share the values.
+
+    Consumers subscribe to sensors with the rate they need. Each sensor is
+    read at most once per tick no matter how many consumers want it, and
+    a sensor isn't read again until the previous value arrives. If batch is
+    True, the sensors which can be read by a binary command are read in one
+    packet (see BinaryBatch), which needs the firmware rebuilt from
+    BTcomDM.c; the shipped BTcomDM.hex hangs on such a packet. The latest value of every sensor is kept, all values are
+    also logged in the TelemetryStore if one is given.
+
+    Usage:
+        scheduler = SensorScheduler(controller)
+        scheduler.subscribe('proximity', 10, callback)
+        scheduler.run()
+
+    """
+
+    # Sensor names and the Controller methods reading them.
+    SENSORS = {
+        'proximity': 'get_proximity_sensors',
+        'ambient': 'get_ambient_sensors',
+        'accelerometer': 'get_accelerometer',
+        'raw_accelerometer': 'get_raw_accelerometer',
+        'speed': 'get_speed',
+        'motor_position': 'get_motor_pos',
+        'selector': 'get_turning_selector',
+        'volume': 'get_volume',
+    }
+
+    def __init__(self, controller, store=None, batch=False):
+        self.controller = controller
+        # TelemetryStore logging all values, None when disabled.
+        self.store = store
+        # Whether the binary reads are sent in one packet.
+        self.batch = batch
+        self.subscriptions = []
+        # Stored are tuples (value, time of arrival) under the sensor name.
+        self.values = {}
+        # Stored are handlers of the reads which haven't finished yet.
+        self.outstanding = {}
+        self.running = False
+
+        self.logger = logging.getLogger('SensorScheduler')
+
+    def subscribe(self, sensor, rate, callback=None):
+        """Read the sensor rate times per second.
+
+        The callback is called with the value whenever it's read for this
+        subscription. Return the subscription, which can be cancelled by
+        unsubscribe.
+
+        """
+        if sensor not in self.SENSORS:
+            raise ValueError("Unknown sensor: %s" % sensor)
+        subscription = Subscription(sensor, 1. / rate, callback)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop reading the sensor for the subscription."""
+        self.subscriptions.remove(subscription)
+
+    def latest(self, sensor):
+        """Return the last value of the sensor or None."""
+        try:
+            return self.values[sensor][0]
+        except KeyError:
+            return None
+
+    def run_once(self, now=None):
+        """Read the sensors that are due.
+
+        Return the time when the next sensor will be due, or None if there
+        are no subscriptions.
+
+        """
+        if now is None:
+            now = time.time()
+
+        due = set()
+        for subscription in self.subscriptions:
+            if subscription.next_due <= now:
+                subscription.waiting = True
+                subscription.next_due = max(subscription.next_due + subscription.period, now)
+                due.add(subscription.sensor)
+
+        due = [sensor for sensor in due if not self._is_outstanding(sensor)]
+
+        batched = [sensor for sensor in due
+                   if self.batch and hasattr(BinaryBatch, self.SENSORS[sensor])]
+        if len(batched) > 1:
+            self._read_batch(batched)
+        else:
+            batched = []
+        for sensor in due:
+            if sensor not in batched:
+                self._read(sensor)
+
+        if not self.subscriptions:
+            return None
+        return min(subscription.next_due for subscription in self.subscriptions)
+
+    def run(self, duration=None):
+        """Read the sensors until stop is called or the duration elapses."""
+        self.running = True
+        end = time.time() + duration if duration is not None else None
+        while self.running and (end is None or time.time() < end):
+            next_due = self.run_once()
+            if next_due is None:
+                break
+            if end is not None:
+                next_due = min(next_due, end)
+            self._wait(max(0, next_due - time.time()))
+
+    def stop(self):
+        """Stop the loop started by run."""
+        self.running = False
+
+    def _wait(self, timeout):
+        """Wait for the next tick, let the event loop run in the meantime."""
+        from epuck.comm.loop import LoopComm
+        comm = self.controller.comm
+        if isinstance(comm, LoopComm):
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                comm.loop.run_once(deadline - time.time())
+        else:
+            time.sleep(timeout)
+
+    def _is_outstanding(self, sensor):
+        """Decide whether the sensor is being read."""
+        handler = self.outstanding.get(sensor)
+        return handler is not None and not handler.done()
+
+    def _read(self, sensor):
+        """Read one sensor."""
+        def _callback(value):
+            self._save(sensor, value)
+            return value
+
+        method = getattr(self.controller, self.SENSORS[sensor])
+        self._track([sensor], method(callback=_callback))
+
+    def _read_batch(self, sensors):
+        """Read the sensors in one packet."""
+        def _callback(values):
+            for sensor, value in zip(sensors, values):
+                self._save(sensor, value)
+            return values
+
+        batch = self.controller.batch(_callback)
+        for sensor in sensors:
+            getattr(batch, self.SENSORS[sensor])()
+        self._track(sensors, batch.send())
+
+    def _track(self, sensors, handler):
+        """Remember the handler of an asynchronous read."""
+        if not hasattr(handler, 'done'):
+            handler = None
+        for sensor in sensors:
+            self.outstanding[sensor] = handler
+
+    def _save(self, sensor, value):
+        """Store the value and pass it to the waiting consumers."""
+        now = time.time()
+        self.values[sensor] = (value, now)
+        if self.store is not None:
+            self.store.append(sensor, value, now)
+        for subscription in self.subscriptions:
+            if subscription.sensor == sensor and subscription.waiting:
+                subscription.waiting = False
+                if subscription.callback is not None:
+                    subscription.callback(value)
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from epuck import EPuckError
+from epuck.comm import EventLoop
+from epuck.controller import Controller
+
+
+# Controller methods sending a command to the robot. The names don't always
+# match controller.COMMANDS, e.g. set_leds sends set_led commands.
+COMMAND_METHODS = frozenset([
+    'set_speed', 'get_speed', 'set_body_led', 'set_front_led', 'set_leds',
+    'set_led', 'get_turning_selector', 'get_proximity_sensors',
+    'get_ambient_sensors', 'set_camera', 'get_camera', 'get_photo', 'reset',
+    'set_motor_pos', 'get_motor_pos', 'get_raw_accelerometer',
+    'get_accelerometer', 'calibrate_sensors', 'stop', 'play_sound',
+    'get_volume', 'get_microphone',
+])
+
+
+class Swarm(object):
+    """Control many robots from one thread.
+
+    All robots share one EventLoop, so there is just one thread waiting for
+    the responses of all of them (a controller with AsyncComm has a thread
+    of its own). Each robot is an ordinary Controller, which can be obtained
+    by swarm[port].
+
+    Any command of the robot (see COMMAND_METHODS) can be called on the
+    swarm. It is sent to all robots at once and a task is returned. The task finishes once all robots
+    answered, its result is a dictionary with the responses under the ports.
+    The robots which failed have the exception instead of the response.
+
+    Usage:
+        swarm = Swarm(['/dev/rfcomm0', '/dev/rfcomm1'])
+        swarm.set_speed(500, 500)
+        sensors = swarm.get_proximity_sensors().get_response()
+
+    """
+
+    def __init__(self, ports=(), timeout=0.5, max_tries=10, loop=None):
+        """Create new swarm.
+
+        Arguments:
+            ports -- The devices where the robots are connected.
+            timeout -- How long to wait before the message is sent again.
+            max_tries -- How many tries before giving up.
+            loop -- EventLoop to use, a new one is created by default.
+
+        """
+        self.loop = loop if loop is not None else EventLoop()
+        self.timeout = timeout
+        self.max_tries = max_tries
+        # Stored are controllers under their ports, in the order they were added.
+        self.robots = {}
+        self.ports = []
+
+        self.logger = logging.getLogger('Swarm')
+
+        for port in ports:
+            self.add(port)
+
+    def add(self, port):
+        """Connect to the robot and return its controller."""
+        if port in self.robots:
+            raise EPuckError("Robot %s is already in the swarm." % port)
+        controller = Controller(port, timeout=self.timeout,
+                                max_tries=self.max_tries, loop=self.loop)
+        self.robots[port] = controller
+        self.ports.append(port)
+        return controller
+
+    def remove(self, port):
+        """Disconnect the robot."""
+        controller = self.robots.pop(port)
+        self.ports.remove(port)
+        controller.comm.close()
+
+    def __getitem__(self, port):
+        return self.robots[port]
+
+    def __iter__(self):
+        return (self.robots[port] for port in self.ports)
+
+    def __len__(self):
+        return len(self.ports)
+
+    def broadcast(self, name, *args, **kwargs):
+        """Call the Controller method sending the command on all robots.
+
+        Return a task finishing with a dictionary of the responses.
+
+        """
+        if name not in COMMAND_METHODS:
+            raise EPuckError("%s is not a command of the robot." % name)
+        handlers = []
+        for port in self.ports:
+            try:
+                handler = getattr(self.robots[port], name)(*args, **kwargs)
+            except EPuckError as e:
+                handler = e
+            handlers.append((port, handler))
+        return self.loop.spawn(self._collect(handlers))
+
+    def __getattr__(self, name):
+        # Other methods (batch, stream_photos, ...) can't be broadcast.
+        if name not in COMMAND_METHODS:
+            raise AttributeError(name)
+
+        def _broadcast(*args, **kwargs):
+            return self.broadcast(name, *args, **kwargs)
+        _broadcast.__name__ = name
+        _broadcast.__doc__ = getattr(Controller, name).__doc__
+        return _broadcast
+
+    def _collect(self, handlers):
+        """Task waiting for the handlers, the requests run concurrently."""
+        responses = {}
+        for port, handler in handlers:
+            if isinstance(handler, Exception):
+                responses[port] = handler
+            elif hasattr(handler, 'add_callback'):
+                try:
+                    responses[port] = yield handler
+                except Exception as e:
+                    self.logger.error("Robot %s failed: %s" % (port, e))
+                    responses[port] = e
+            else:
+                responses[port] = handler
+        raise StopIteration(responses)
+
+    def run_until_complete(self, task):
+        """Run the loop until the task is done and return its result."""
+        return self.loop.run_until_complete(task)
+
+    def close(self):
+        """Disconnect all robots."""
+        for port in list(self.ports):
+            self.remove(port)
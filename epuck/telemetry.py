@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import array
+import time
+
+from epuck.records import Record
+
+
+class RingBuffer(object):
+    """The last capacity samples of one sensor.
+
+    The values are kept in one contiguous array, sample after sample, and
+    the times of the samples in another one. No objects are created per
+    sample, so the buffer can log the sensor for a long time with constant
+    memory. The statistics are computed over the last samples or over the
+    samples since given time.
+
+    """
+
+    def __init__(self, fields, capacity=1000, typecode='d'):
+        """Create an empty buffer.
+
+        Arguments:
+            fields -- Names of the values of a sample, or a Record type.
+            capacity -- How many samples are kept.
+            typecode -- Type of the values, see the array module.
+
+        """
+        if isinstance(fields, type) and issubclass(fields, Record):
+            self.record = fields
+            fields = fields.FIELDS
+        else:
+            self.record = None
+        self.fields = tuple(fields)
+        self.index = dict((field, i) for i, field in enumerate(self.fields))
+        self.width = len(self.fields)
+        self.capacity = capacity
+
+        self.data = array.array(typecode, [0]) * (capacity * self.width)
+        self.times = array.array('d', [0.]) * capacity
+        # Position where the next sample is written.
+        self.position = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, values, timestamp=None):
+        """Store the sample, overwrite the oldest one if the buffer is full.
+
+        The values are a sequence in the order of the fields, a dictionary
+        with the fields as keys, or a number if there is only one field.
+
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(values, dict):
+            values = [values[field] for field in self.fields]
+        start = self.position * self.width
+        if self.width == 1 and not hasattr(values, '__len__'):
+            self.data[start] = values
+        else:
+            self.data[start:start + self.width] = array.array(
+                self.data.typecode, values)
+        self.times[self.position] = timestamp
+        self.position = (self.position + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        """Forget all samples."""
+        self.position = 0
+        self.count = 0
+
+    def latest(self):
+        """Return the last sample (a record if the fields are a Record type)."""
+        if not self.count:
+            return None
+        start = (self.position - 1) % self.capacity * self.width
+        values = self.data[start:start + self.width]
+        return self.record(values) if self.record is not None else tuple(values)
+
+    def column(self, field, since=None):
+        """Return an array with the values of the field from oldest to newest.
+
+        Only the samples taken at the time since or later are returned if it
+        is given.
+
+        """
+        if not isinstance(field, int):
+            field = self.index[field]
+        column = self.data[field::self.width]
+        return self._ordered(column, since)
+
+    def timestamps(self, since=None):
+        """Return an array with the times of the samples."""
+        return self._ordered(self.times, since)
+
+    def mean(self, field, since=None):
+        """Return the mean value of the field, None if there are no samples."""
+        column = self.column(field, since)
+        return sum(column) / float(len(column)) if column else None
+
+    def minimum(self, field, since=None):
+        """Return the minimal value of the field, None if there are no samples."""
+        column = self.column(field, since)
+        return min(column) if column else None
+
+    def maximum(self, field, since=None):
+        """Return the maximal value of the field, None if there are no samples."""
+        column = self.column(field, since)
+        return max(column) if column else None
+
+    def _oldest(self):
+        """Return the position of the oldest sample."""
+        return (self.position - self.count) % self.capacity
+
+    def _ordered(self, values, since):
+        """Return the stored part of values with one item per sample in order."""
+        oldest = self._oldest()
+        end = oldest + self.count
+        if end <= self.capacity:
+            ordered = values[oldest:end]
+        else:
+            ordered = values[oldest:] + values[:end - self.capacity]
+        if since is not None:
+            ordered = ordered[self._first_since(since):]
+        return ordered
+
+    def _first_since(self, since):
+        """Return the number of samples taken before the time since."""
+        # The samples are appended in time order, so binary search works.
+        oldest = self._oldest()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[(oldest + middle) % self.capacity] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class TelemetryStore(object):
+    """Ring buffers of several sensors.
+
+    The buffer of a sensor is created with its first value. Records create
+    buffers with their fields, dictionaries with their sorted keys,
+    sequences with numbered fields and numbers with one field 'value'. The
+    store can be passed to SensorScheduler, which then logs all values it
+    reads.
+
+    Usage:
+        store = TelemetryStore(capacity=600)
+        scheduler = SensorScheduler(controller, store=store)
+        ...
+        store['proximity'].mean('L10', since=time.time() - 5)
+
+    """
+
+    def __init__(self, capacity=1000, typecode='d'):
+        self.capacity = capacity
+        self.typecode = typecode
+        # Stored are RingBuffers under the sensor names.
+        self.buffers = {}
+
+    def __getitem__(self, sensor):
+        return self.buffers[sensor]
+
+    def __contains__(self, sensor):
+        return sensor in self.buffers
+
+    def __iter__(self):
+        return iter(self.buffers)
+
+    def append(self, sensor, value, timestamp=None):
+        """Store the value of the sensor."""
+        buffer = self.buffers.get(sensor)
+        if buffer is None:
+            if isinstance(value, Record):
+                fields = type(value)
+            elif isinstance(value, dict):
+                fields = sorted(value)
+            elif hasattr(value, '__len__'):
+                fields = range(len(value))
+            else:
+                fields = ['value']
+            buffer = self.buffers[sensor] = RingBuffer(fields, self.capacity,
+                                                       self.typecode)
+        buffer.append(value, timestamp)
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import math
+
+import Image
+
+from epuck.records import record_type
+
+# Centroid and number of pixels of the blob found by blob().
+Blob = record_type('Blob', ['x', 'y', 'area'])
+
+
+def _numpy():
+    """Import NumPy, which is needed only by this module."""
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("NumPy is required for processing the photos.")
+    return numpy
+
+
+def to_array(image):
+    """Return the photo (a PIL image or a Frame) as an array of bytes.
+
+    The array has shape (height, width) for greyscale photos and (height,
+    width, 3) for color ones.
+
+    """
+    numpy = _numpy()
+    image = getattr(image, 'image', image)
+    data = image.tobytes() if hasattr(image, 'tobytes') else image.tostring()
+    width, height = image.size
+    array = numpy.frombuffer(data, dtype=numpy.uint8)
+    if image.mode == 'L':
+        return array.reshape(height, width)
+    return array.reshape(height, width, len(image.mode))
+
+
+def to_image(array):
+    """Return the array as a PIL image, the values are clipped to [0, 255].
+
+    Boolean arrays (masks) are converted to black and white images.
+
+    """
+    numpy = _numpy()
+    array = numpy.asarray(array)
+    if array.dtype == bool:
+        array = array * 255
+    data = numpy.clip(array, 0, 255).astype(numpy.uint8)
+    height, width = data.shape[:2]
+    mode = 'L' if data.ndim == 2 else 'RGB'
+    return Image.fromstring(mode, (width, height), data.tostring())
+
+
+def rgb_to_hsv(rgb):
+    """Convert the RGB array to an array of hue, saturation and value.
+
+    The hue is in sextants, i.e. in the range [0, 6) with red at 0, green
+    at 2 and blue at 4, and it's 0 for greys. The saturation and the value
+    are in the range [0, 1].
+
+    """
+    numpy = _numpy()
+    rgb = numpy.asarray(rgb, dtype=numpy.float32)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maximum = rgb.max(axis=-1)
+    chroma = maximum - rgb.min(axis=-1)
+
+    grey = chroma == 0
+    divisor = numpy.where(grey, 1, chroma)
+    hue = numpy.where(maximum == r, ((g - b) / divisor) % 6,
+                      numpy.where(maximum == g, (b - r) / divisor + 2,
+                                  (r - g) / divisor + 4))
+    hue[grey] = 0
+    saturation = numpy.where(maximum == 0, 0,
+                             chroma / numpy.where(maximum == 0, 1, maximum))
+    return numpy.stack([hue, saturation, maximum / 255.], axis=-1)
+
+
+def threshold(hsv, hue=None, saturation=None, value=None):
+    """Return the mask of pixels with the color in given ranges.
+
+    Every range is a tuple (low, high), None means any value. The hue range
+    can wrap around red, e.g. (5.7, 0.3).
+
+    """
+    numpy = _numpy()
+    mask = numpy.ones(hsv.shape[:2], dtype=bool)
+    if hue is not None:
+        low, high = hue
+        h = hsv[..., 0]
+        if low <= high:
+            mask &= (h >= low) & (h <= high)
+        else:
+            mask &= (h >= low) | (h <= high)
+    for channel, limits in ((1, saturation), (2, value)):
+        if limits is not None:
+            low, high = limits
+            mask &= (hsv[..., channel] >= low) & (hsv[..., channel] <= high)
+    return mask
+
+
+def _box_blur_axis(numpy, data, radius, axis):
+    """Average the values in the window of 2 * radius + 1 along the axis.
+
+    Sums of the windows are differences of the cumulative sums, so the blur
+    takes the same time for any radius. The windows at the edges are
+    shorter.
+
+    """
+    n = data.shape[axis]
+    zeros = numpy.zeros(data.shape[:axis] + (1,) + data.shape[axis + 1:])
+    cumsum = numpy.concatenate([zeros, numpy.cumsum(data, axis=axis)], axis=axis)
+
+    index = numpy.arange(n)
+    upper = numpy.minimum(index + radius + 1, n)
+    lower = numpy.maximum(index - radius, 0)
+    sums = numpy.take(cumsum, upper, axis=axis) - numpy.take(cumsum, lower, axis=axis)
+
+    shape = [1] * data.ndim
+    shape[axis] = n
+    return sums / (upper - lower).reshape(shape)
+
+
+def box_blur(array, radius=1):
+    """Return the array averaged over squares of side 2 * radius + 1.
+
+    Works for greyscale and color arrays, the result is an array of floats.
+
+    """
+    numpy = _numpy()
+    data = numpy.asarray(array, dtype=numpy.float64)
+    for axis in (0, 1):
+        data = _box_blur_axis(numpy, data, radius, axis)
+    return data
+
+
+def gaussian_blur(array, sigma=1.0, passes=3):
+    """Return the array blurred by approximately Gaussian filter.
+
+    The filter is approximated by repeated box blur, three passes are
+    within few percent of the Gaussian.
+
+    """
+    width = math.sqrt(12. * sigma ** 2 / passes + 1)
+    radius = max(1, int(round((width - 1) / 2)))
+    for i in range(passes):
+        array = box_blur(array, radius)
+    return array
+
+
+def blob(mask):
+    """Return the Blob with the centroid and the area of the mask.
+
+    Return None if the mask is empty.
+
+    """
+    numpy = _numpy()
+    ys, xs = numpy.nonzero(mask)
+    if not len(xs):
+        return None
+    return Blob((float(xs.mean()), float(ys.mean()), len(xs)))
@@ -1,11 +1,11 @@
 #!/usr/bin/python
 
-import functools
 import Image as Img
 
 from Tkinter import *
 from ImageTk import PhotoImage
-from epuck import Controller
+from epuck import Controller, vision
+from epuck.pipeline import Pipeline
 
 c = Controller('/dev/rfcomm0', asynchronous=True)
 c.set_camera(Controller.RGB565_MODE, 40, 40, 8)
@@ -16,74 +16,28 @@ img_camera.pack()
 img_modified = Label(root)
 img_modified.pack()
 
-def hue(r, g, b):
-    M = max(r, g, b)
-    m = min(r, g, b)
-    C = M - m
+def analyse(image):
+    i = vision.to_array(image.resize((100,100), Img.ANTIALIAS))
+    blurred = vision.box_blur(i, radius=1)
+    hsv = vision.rgb_to_hsv(blurred)
+    red = vision.threshold(hsv, hue=(5.7, 0.3), saturation=(0.4, 1),
+                           value=(0.3, 1))
+    return (vision.to_image(blurred).tostring(),
+            vision.to_image(red).convert('RGB').tostring())
 
-    if C == 0:
-        return None
-    if M == r:
-        h = float(g-b)/C % 6
-    elif M == g:
-        h = float(b-r)/C + 2
-    elif M == b:
-        h = float(r-g)/C + 4
-
-    return h
-
-def reduce_noise(image):
-    step = 2
-    for i in range(0, image.size[0]-step, step):
-        for j in range(0, image.size[1]-step, step):
-            pixels = [image.getpixel((i+x, j+y)) for x in range(step) for y in range(step)]
-            sum_pixels = functools.reduce(
-                lambda (r1,g1,b1), (r2,g2,b2): (r1+r2, g1+g2, b1+b2),
-                pixels)
-            avg_pixel = map(lambda x: x / (step * step), sum_pixels)
-
-            for x in range(step):
-                for y in range(step):
-                    image.putpixel((i+x, j+y), tuple(avg_pixel))
-
-def saturation(r, g, b):
-    V = M = max(r,g,b)
-    m = min(r,g,b)
-    C = M - m
-    if C == 0:
-        return 0
-    else:
-        return float(C)/V
-
-def value(r, g, b):
-    return max(r, g, b) / 255.0
-
-def filter_red(image):
-    saturation_threshold = 0.4
-    value_threshold = 0.3
-    data = []
-    for (r,g,b) in image.getdata():
-        h = hue(r, g, b)
-        if (h < 0.3 or h > 5.7) \
-           and saturation(r, g, b) > saturation_threshold \
-           and value(r, g, b) > value_threshold:
-            data.append((255, 255, 255))
-        else:
-            data.append((0, 0, 0))
-
-    image.putdata(data)
-    return image
+# Filter the photos in other processes while next photos are taken
+pipeline = Pipeline(analyse, ordered=False)
+results = pipeline.process(c.stream_photos())
 
 def get_image():
     global img_camera, img_modified
-    i = c.get_photo().get_response().resize((100,100), Img.ANTIALIAS)
-    reduce_noise(i)
+    frame, (camera, modified) = results.next()
 
-    img = PhotoImage(i)
+    img = PhotoImage(Img.fromstring('RGB', (100,100), camera))
     img_camera.configure(image=img)
     img_camera.img = img
 
-    img_m = PhotoImage(filter_red(i))
+    img_m = PhotoImage(Img.fromstring('RGB', (100,100), modified))
     img_modified.configure(image=img_m)
     img_modified.img = img_m
 
@@ -91,5 +45,6 @@ def get_image():
 
 get_image()
 root.mainloop()
+pipeline.close()
 
 
@@ -21,7 +21,9 @@ class Disco(object):
     """
     def __init__(self):
         logging.basicConfig(level=logging.WARNING)
-        self.c = Controller('/dev/rfcomm0', asynchronous=True)
+        # The selector is polled all the time, it's enough to ask the robot
+        # five times per second.
+        self.c = Controller('/dev/rfcomm0', asynchronous=True, cache_ttl=0.2)
         self.state_request = None
         # Get first state
         self.state = self.c.get_turning_selector().get_response()
@@ -21,6 +21,8 @@ c = Controller('/dev/rfcomm0', timeout=5, asynchronous=True)
 # Set camera properties
 c.set_front_led(1)
 c.set_camera(Controller.GREYSCALE_MODE, 55, 55, 8)
+# Take next photo while the previous one is being processed
+frames = c.stream_photos(drop=True)
 
 # Create the application layout
 root = Tk()
@@ -31,8 +33,8 @@ cascade = cv.Load('haarcascade_frontalface_alt.xml')
 
 def show_photo():
     # Get the photo
-    img = c.get_photo() \
-        .get_response() \
+    img = frames.next() \
+        .image \
         .resize((300, 300), Img.ANTIALIAS)
 
     # Convert the photo for OpenCV
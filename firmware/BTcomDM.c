@@ -144,12 +144,31 @@ static void init_lvd(){
                 _LVDIE=1; // enable interrupt
 }
 
+/* \brief Number of argument bytes following the binary command c */
+static int binary_arg_count(char c) {
+	switch(-c) {
+	case 'Z':
+		return 1;
+	case 'D':
+		return 4;
+	case 'L':
+		return 2;
+#ifdef LIS_SENSORS_TURRET
+	case 'W':
+		return 2;
+#endif
+	default:
+		return 0;
+	}
+}
+
 /* \brief The main function of the programm */
 int main(void) {
 	char c,c1,c2,wait_cam=0,tmstmp, last_tmstmp;
 	int	i,j,n,speedr=0,speedl=0,positionr,positionl,LED_nbr,LED_action,accx,accy,accz,selector,sound;
 	int cam_mode,cam_width,cam_heigth,cam_zoom,cam_size;
 	int listening = 0;
+	int answer_size = 0; // size of the last binary answer, for a resend
 	static char first=0;
 	char *address;
 	char *ptr;
@@ -559,11 +578,20 @@ int main(void) {
                     default: // silently ignored
                         break;
                     }
-                    while (e_getchar_uart1(&c)==0); // get next command
+                } else { // the packet has been executed already, skip arguments
+                    for (j = binary_arg_count(c); j > 0; j--)
+                        while (e_getchar_uart1(&c1)==0);
                 }
-                last_tmstmp = tmstmp;
+                // Several commands can be sent in one packet, they share the
+                // timestamp and their answers are concatenated.
+                while (e_getchar_uart1(&c)==0); // get next command
 			} while(c < 0);
 
+			if (last_tmstmp == tmstmp) // the answer was lost, send it again
+				i = answer_size;
+			answer_size = i;
+			last_tmstmp = tmstmp;
+
 			if (i!=0){
 				if (wait_cam) {
 					wait_cam=0;
@@ -833,6 +861,7 @@ int main(void) {
                 }
             }
             last_tmstmp = tmstmp;
+            answer_size = 0; // the buffer has been overwritten
 		}
 	}
 }
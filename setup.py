@@ -14,6 +14,7 @@ setup(name='epuck',
     download_url='http://atrey.karlin.mff.cuni.cz/~davidm/epuck-0.9.1.tar.gz',
     license='LGPL',
     install_requires=['pyserial'],
+    extras_require={'audio': ['numpy'], 'vision': ['numpy']},
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: Console',
@@ -25,7 +26,7 @@ setup(name='epuck',
         'Natural Language :: English',
         'Natural Language :: Czech',
         'Operating System :: POSIX',
-        'Programming Language :: Python :: 2.5',
+        'Programming Language :: Python :: 2.7',
         'Topic :: Software Development :: Libraries :: Python Modules',
         'Topic :: Scientific/Engineering'
     ],